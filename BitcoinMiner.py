@@ -1,54 +1,138 @@
+from CpuEngine import CpuEngine
+from KernelCache import KernelCache
+from KernelSizer import KernelSizer
+from Metrics import Metrics, MetricsServer
 from Queue import Queue, Empty
+from copy import copy
 from decimal import Decimal
 from hashlib import md5
 from log import *
 from sha256 import *
 from struct import pack
+from multiprocessing import cpu_count
 from threading import Thread
 from time import sleep, time
+from tuning import load_tuning, save_tuning
 from util import *
 import log
-import pyopencl as cl
+
+try:
+	import pyopencl as cl
+except ImportError:
+	cl = None
 
 
 class BitcoinMiner():
-	def __init__(self, device, options, version, transport):
-		self.stale = False
+	def __init__(self, devices, options, version, transport):
 		self.output_size = 0x100
 		self.options = options
 		self.version = version
-		(self.defines, self.rate_divisor, self.hashspace) = if_else(self.options.vectors, ('-DVECTORS', 500, 0x7FFFFFFF), ('', 1000, 0xFFFFFFFF))
-		self.defines += (' -DOUTPUT_SIZE=' + str(self.output_size))
-		self.defines += (' -DOUTPUT_MASK=' + str(self.output_size - 1))
 
-		self.device = device
 		self.options.rate = if_else(self.options.verbose, max(self.options.rate, 60), max(self.options.rate, 0.1))
 		self.options.askrate = max(self.options.askrate, 1)
 		self.options.askrate = min(self.options.askrate, 10)
 		self.options.frames = max(self.options.frames, 3)
 
+		# every device mines a disjoint slice of the nonce space of the same work unit
+		self.devices = []
+		self.device_count = len(devices)
+		for i in xrange(len(devices)):
+			device = Object()
+			device.device = devices[i]
+			device.name = devices[i].name.strip() if devices[i] else 'CPU'
+			device.index = str(i)
+			device.work_queue = Queue()
+			device.stale = False
+			device.rate = 0
+			device.launch_rate = 0
+			device.context = None
+			self.configure_defaults(device)
+			if not device.device:
+				# the process pool has to be forked before any other thread is started
+				device.miner = CpuEngine(device.output_size, device.vectors)
+				device.fingerprint = md5(''.join(['CPU', str(device.miner.processes), device.defines])).hexdigest()
+			self.devices.append(device)
+
 		self.update_time = False
 		self.share_count = [0, 0]
-		self.work_queue = Queue()
+		self.targetQ = 0
+		self.metrics = Metrics()
+		self.kernel_cache = KernelCache(self.options.kernel_cache, self.options.kernel_cache_size * 2 ** 20)
+		self.tuning = if_else(self.options.tuning_file, load_tuning(self.options.tuning_file), {})
 		self.transport = transport(self)
 		log.verbose = self.options.verbose
 		log.quiet = self.options.quiet
 
+	def configure(self, device, worksize, vectors, output_size, bitalign, bfi_int):
+		device.worksize = worksize
+		device.vectors = vectors
+		device.output_size = output_size
+		device.bitalign = bitalign
+		device.bfi_int = bfi_int
+		device.defines = if_else(vectors, '-DVECTORS', '')
+		device.defines += (' -DOUTPUT_SIZE=' + str(output_size))
+		if bitalign: device.defines += ' -DBITALIGN'
+		if bfi_int: device.defines += ' -DBFI_INT'
+		# vector kernels search two nonces per thread
+		device.rate_divisor = if_else(vectors, 500, 1000)
+		device.nonce_space = 0x100000000 / self.device_count / if_else(vectors, 2, 1)
+		device.nonce_start = int(device.index) * device.nonce_space
+
+	def configure_defaults(self, device):
+		media_ops = bool(device.device) and device.device.extensions.find('cl_amd_media_ops') != -1
+		self.configure(device, self.options.worksize, bool(self.options.vectors), self.output_size, media_ops, media_ops)
+
+	def settings(self, device):
+		return {'worksize': device.worksize, 'vectors': device.vectors, 'output_size': device.output_size, 'bitalign': device.bitalign, 'bfi_int': device.bfi_int}
+
 	def start(self):
 		self.should_stop = False
-		Thread(target=self.mining_thread).start()
+		if self.options.metrics_port:
+			MetricsServer((self.options.metrics_host, self.options.metrics_port), self.metrics).start()
+		for device in self.devices:
+			Thread(target=self.mining_thread, args=(device,)).start()
+		thread = Thread(target=self.status_thread)
+		thread.daemon = True
+		thread.start()
 		self.transport.loop()
 
 	def stop(self):
 		self.transport.stop()
 		self.should_stop = True
 
-	def say_status(self, rate, estimated_rate):
-		rate = Decimal(rate) / 1000
+	def queue_work(self, work):
+		if work:
+			self.targetQ = work.targetQ
+		for device in self.devices:
+			device.work_queue.put(self.device_work(work))
+
+	def device_work(self, work):
+		if work:
+			# ntime rolling changes time, state2 and f in place
+			work = copy(work)
+			work.f = np.array(work.f)
+		return work
+
+	def next_work(self, device):
+		work = self.transport.next_work()
+		if work:
+			device.work_queue.put(self.device_work(work))
+		return work
+
+	def set_stale(self):
+		for device in self.devices:
+			device.stale = True
+
+	def say_status(self, rates, estimated_rate):
+		rate = Decimal(sum(rates)) / 1000
 		estimated_rate = Decimal(estimated_rate) / 1000
 		total_shares = self.share_count[1] + self.share_count[0]
 		total_shares_estimator = max(total_shares, total_shares, 1)
-		say_quiet('[%.03f MH/s (~%d MH/s)] [Rej: %d/%d (%.02f%%)]', (rate, round(estimated_rate), self.share_count[0], total_shares, float(self.share_count[0]) * 100 / total_shares_estimator))
+		if len(rates) > 1:
+			devices = ' [%s]' % ' '.join(['%d: %.03f' % (i, Decimal(rates[i]) / 1000) for i in xrange(len(rates))])
+		else:
+			devices = ''
+		say_quiet('[%.03f MH/s (~%d MH/s)] [Rej: %d/%d (%.02f%%)]%s', (rate, round(estimated_rate), self.share_count[0], total_shares, float(self.share_count[0]) * 100 / total_shares_estimator, devices))
 
 	def diff1_found(self, hash, target):
 		if self.options.verbose and target < 0xFFFF0000L:
@@ -59,137 +143,335 @@ class BitcoinMiner():
 		if self.options.verbose or is_block:
 			say_line('%s%s, %s', (if_else(is_block, 'block ', ''), hash, if_else(accepted, 'accepted', '_rejected_')))
 
-	def mining_thread(self):
-		self.load_kernel()
-		frame = 1.0 / self.options.frames
-		unit = self.options.worksize * 256
-		global_threads = unit * 10
-		
-		queue = cl.CommandQueue(self.context)
-
-		start_time = last_rated_pace = last_rated = last_n_time = time()
-		base = last_hash_rate = threads_run_pace = threads_run = 0
+	def status_thread(self):
+		start_time = time()
 		accept_hist = []
-		output = np.zeros(self.output_size + 1, np.uint32)
-		output_buffer = cl.Buffer(self.context, cl.mem_flags.WRITE_ONLY | cl.mem_flags.USE_HOST_PTR, hostbuf=output)
-
-		work = None
 		while True:
-		        sleep(self.options.frameSleep)
+			sleep(self.options.rate)
 			if self.should_stop: return
 
-			if self.stale:
-				self.stale = False
+			now = time()
+			if accept_hist:
+				LAH = accept_hist.pop()
+				if LAH[1] != self.share_count[1]:
+					accept_hist.append(LAH)
+			accept_hist.append((now, self.share_count[1]))
+			while (accept_hist[0][0] < now - self.options.estimate):
+				accept_hist.pop(0)
+			new_accept = self.share_count[1] - accept_hist[0][1]
+			estimated_rate = Decimal(new_accept) * (self.targetQ) / max(min(int(now - start_time), self.options.estimate), 1) / 1000
+
+			self.say_status([device.rate for device in self.devices], estimated_rate)
+
+	def mining_thread(self, device):
+		if device.device:
+			if self.options.autotune:
+				self.autotune(device)
+			self.load_kernel(device)
+			# launches are sized from the kernel execution times of the profiling info
+			queue = cl.CommandQueue(device.context, properties=cl.command_queue_properties.PROFILING_ENABLE)
+		else:
+			if (device.worksize == -1):
+				device.worksize = 64
+			queue = None
+		tuning_key = '%s/%d' % (device.fingerprint, device.worksize)
+		device.sizer = KernelSizer(device.worksize * 256, 1.0 / self.options.frames, device.nonce_space, self.tuning.get('rates', {}).get(tuning_key))
+		global_threads = device.sizer.size()
+
+		# several launches are kept in flight, each with its own output buffer
+		slots = []
+		for i in xrange(max(self.options.pipeline, 1)):
+			slot = Object()
+			slot.output = np.zeros(device.output_size + 1, np.uint32)
+			slot.event = slot.args = None
+			if queue:
+				slot.buffer = cl.Buffer(device.context, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR, hostbuf=slot.output)
+				slot.kernel = cl.Kernel(device.miner, 'search')
+			else:
+				slot.buffer = slot.output
+				slot.found = slot.output[device.output_size:]
+				slot.kernel = device.miner.kernel()
+			slots.append(slot)
+		if queue:
+			# only the found counts are read back after every launch, into pinned host memory
+			flags_buffer = cl.Buffer(device.context, cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR, 4 * len(slots))
+			(flags, event) = cl.enqueue_map_buffer(queue, flags_buffer, cl.map_flags.READ | cl.map_flags.WRITE, 0, (len(slots),), np.uint32, is_blocking=True)
+			for i in xrange(len(slots)):
+				slots[i].found = flags[i:i+1]
+
+		last_rated = last_n_time = last_saved = time()
+		base = threads_run = launches = launches_run = 0
+
+		work = args = None
+		while True:
+			sleep(self.options.frameSleep)
+			if self.should_stop:
+				if not queue: device.miner.close()
+				self.save_rate(tuning_key, device)
+				return
+
+			if device.stale:
+				device.stale = False
 				work = None
+				for slot in slots:
+					slot.stale = True
 
-			if (not work) or (not self.work_queue.empty()):
+			if (not work) or (not device.work_queue.empty()):
+				if not work:
+					for slot in slots:
+						self.collect(device, queue, slot)
 				try:
-					work = self.work_queue.get(True, 1)
+					work = device.work_queue.get(True, 1)
 				except Empty: continue
 				else:
 					if not work: continue
-					nonces_left = self.hashspace
+					nonces_left = device.nonce_space
+					base = device.nonce_start
 					state = work.state
 					state2 = work.state2
 					f = work.f
+					args = None
 
-			self.miner.search(queue, (global_threads,), (self.options.worksize,),
-								state[0], state[1], state[2], state[3], state[4], state[5], state[6], state[7],
-								state2[1], state2[2], state2[3], state2[5], state2[6], state2[7],
-								pack('I', base),
-								f[0], f[1], f[2], f[3], f[4], # f[5], f[6], f[7],
-								output_buffer)
-			cl.enqueue_read_buffer(queue, output_buffer, output)
+			slot = slots[launches % len(slots)]
+			self.collect(device, queue, slot)
+			global_threads = device.sizer.size()
+			slot.threads = global_threads
+			if not args:
+				args = (state[0], state[1], state[2], state[3], state[4], state[5], state[6], state[7],
+						state2[1], state2[2], state2[3], state2[5], state2[6], state2[7],
+						pack('I', base),
+						f[0], f[1], f[2], f[3], f[4], # f[5], f[6], f[7],
+						work.target6)
+			# job arguments are bound once per slot and job or ntime, launches only move the base
+			if slot.args is not args:
+				slot.kernel.set_args(*(args + (slot.buffer,)))
+				slot.args = args
+			slot.kernel.set_arg(14, pack('I', base))
+			if queue:
+				slot.event = cl.enqueue_nd_range_kernel(queue, slot.kernel, (global_threads,), (device.worksize,))
+			else:
+				slot.event = slot.kernel.enqueue((global_threads,), (device.worksize,))
+			slot.kernel_event = slot.event
+			if queue:
+				slot.event = cl.enqueue_read_buffer(queue, slot.buffer, slot.found, device_offset=4 * device.output_size, wait_for=[slot.event], is_blocking=False)
+				queue.flush()
+			launches += 1
+			launches_run += 1
 
-			if self.stale:
-				self.stale = False
-				work = None
-				continue
+			# ntime rolling changes work in place, so remember what this launch searched
+			slot.stale = False
+			slot.result = result = Object()
+			result.header = work.header
+			result.server = work.server
+			result.merkle_end = work.merkle_end
+			result.time = work.time
+			result.difficulty = work.difficulty
+			result.target = work.target
+			result.state = np.array(state)
 
 			nonces_left -= global_threads
-			threads_run_pace += global_threads
 			threads_run += global_threads
-			base = uint32(base + global_threads)
+			base += global_threads
+			if base + global_threads > device.nonce_start + device.nonce_space:
+				# stay inside this device's slice of the nonce space
+				base = device.nonce_start
 
 			now = time()
-			t = now - last_rated_pace
-			if (t > 1):
-				rate = (threads_run_pace / t) / self.rate_divisor
-				last_rated_pace = now; threads_run_pace = 0
-				r = last_hash_rate / rate
-				if r < 0.9 or r > 1.1:
-					global_threads = max(unit * int((rate * frame * self.rate_divisor) / unit), unit)
-					last_hash_rate = rate
 			t = now - last_rated
 			if (t > self.options.rate):
-				rate = int((threads_run / t) / self.rate_divisor)
-
-				if accept_hist:
-					LAH = accept_hist.pop()
-					if LAH[1] != self.share_count[1]:
-						accept_hist.append(LAH)
-				accept_hist.append((now, self.share_count[1]))
-				while (accept_hist[0][0] < now - self.options.estimate):
-					accept_hist.pop(0)
-				new_accept = self.share_count[1] - accept_hist[0][1]
-				estimated_rate = Decimal(new_accept) * (work.targetQ) / min(int(now - start_time), self.options.estimate) / 1000
-
-				self.say_status(rate, estimated_rate)
-				last_rated = now; threads_run = 0
-
-			queue.finish()
-
-			if output[self.output_size]:
-				result = Object()
-				result.header = work.header
-				result.merkle_end = work.merkle_end
-				result.time = work.time
-				result.difficulty = work.difficulty
-				result.target = work.target
-				result.state = np.array(state)
-				result.nonce = np.array(output)
-				self.transport.result_queue.put(result)
-				output.fill(0)
-				cl.enqueue_write_buffer(queue, output_buffer, output)
-
-			if not self.update_time:
-				if nonces_left < (self.transport.timeout + 1) * global_threads * self.options.frames:
+				device.rate = int((threads_run / t) / device.rate_divisor)
+				self.metrics.set('hash_rate', device.rate * 1000, device=device.index)
+				device.launch_rate = launches_run / t
+				last_rated = now; threads_run = launches_run = 0
+			if now - last_saved > 60:
+				self.save_rate(tuning_key, device)
+				last_saved = now
+
+			if not work.rolls:
+				if nonces_left < global_threads and self.next_work(device):
+					# switch to a prefetched job without a round trip to the pool
+					continue
+				if nonces_left < (self.transport.timeout + 1) * global_threads * self.options.frames and not self.transport.prefetched():
 					self.transport.update = True
+					self.transport.wake()
 					nonces_left += 0xFFFFFFFFFFFF
 				elif 0xFFFFFFFFFFF < nonces_left < 0xFFFFFFFFFFFF:
-					say_line('warning: job finished, miner is idle')
+					say_line('warning: job finished, %s is idle', device.name)
 					work = None
-			elif now - last_n_time > 1:
-				work.time = bytereverse(bytereverse(work.time) + 1)
-				state2 = partial(state, work.merkle_end, work.time, work.difficulty, f)
-				calculateF(state, work.merkle_end, work.time, work.difficulty, f, state2)
+			elif now - last_n_time > 1 or nonces_left < global_threads:
+				# ntime follows the clock, only a device that finished its nonce range early runs ahead of it
+				offset = max(work.rolls.elapsed(now), work.offset + if_else(nonces_left < global_threads, 1, 0))
+				if offset > work.rolls.limit(now):
+					# the rolling window is over or this device is too far ahead, new work is needed
+					if not self.next_work(device):
+						self.transport.update = True
+						self.transport.wake()
+						say_line('warning: job finished, %s is idle', device.name)
+					work = None
+				elif offset != work.offset:
+					(work.time, state2, f) = work.rolls.get(offset)
+					work.offset = offset
+					self.transport.wake()
+					args = None
+					# a new ntime makes the whole nonce range fresh again
+					nonces_left = device.nonce_space
+					base = device.nonce_start
 				last_n_time = now
 
-	def load_kernel(self):
-		self.context = cl.Context([self.device], None, None)
-		if (self.device.extensions.find('cl_amd_media_ops') != -1):
-			self.defines += ' -DBITALIGN'
-			self.defines += ' -DBFI_INT'
+	def collect(self, device, queue, slot):
+		if not slot.event: return
+		with self.metrics.timer('wait', device=device.index):
+			slot.event.wait()
+		slot.event = None
+		profile = slot.kernel_event.profile
+		kernel_time = (profile.end - profile.start) * 1e-9
+		device.sizer.update(slot.threads, kernel_time)
+		self.metrics.observe('kernel', kernel_time, device=device.index)
+		self.metrics.observe('queue', (profile.start - profile.queued) * 1e-9, device=device.index)
+		if slot.found[0]:
+			# only the nonces the kernel appended are read back
+			found = min(int(slot.found[0]), device.output_size)
+			if queue:
+				with self.metrics.timer('readback', device=device.index):
+					cl.enqueue_read_buffer(queue, slot.buffer, slot.output[:found]).wait()
+			if slot.stale:
+				self.metrics.count('shares', found, result='stale', pool=slot.result.server[4])
+			else:
+				slot.result.nonce = np.array(slot.output[:found])
+				self.transport.result_queue.put(slot.result)
+				self.transport.wake()
+			slot.found[0] = 0
+			if queue: cl.enqueue_write_buffer(queue, slot.buffer, slot.found, device_offset=4 * device.output_size)
+
+	def save_rate(self, key, device):
+		# warm starts begin with the launch size this device was tuned to
+		if self.options.tuning_file and device.sizer.rate():
+			save_tuning(self.options.tuning_file, 'rates', key, device.sizer.rate())
+
+	def autotune(self, device):
+		# the search is keyed by the device and kernel alone, not by the settings it picks
+		key = self.fingerprint(device, '', self.kernel_source())
+		settings = self.tuning.get('settings', {}).get(key)
+		if not settings:
+			say_line('autotuning %s, this takes a while', device.name)
+			settings = self.search_settings(device)
+			if not settings:
+				# nothing is stored, the next start searches again
+				self.configure_defaults(device)
+				return
+			if self.options.tuning_file:
+				save_tuning(self.options.tuning_file, 'settings', key, settings)
+		self.configure(device, **dict([(str(name), value) for name, value in settings.items()]))
+
+	def variants(self, device):
+		# every combination of defines the autotuner tries, vectors, output size, BITALIGN and BFI_INT
+		media_ops = device.device.extensions.find('cl_amd_media_ops') != -1
+		for vectors in (False, True):
+			for output_size in (0x100, 0x400):
+				for (bitalign, bfi_int) in if_else(media_ops, [(False, False), (True, False), (True, True)], [(False, False)]):
+					yield (vectors, output_size, bitalign, bfi_int)
+
+	def search_settings(self, device):
+		best = (0, None)
+		for variant in self.variants(device):
+			self.configure(device, -1, *variant)
+			try:
+				self.load_kernel(device)
+			except cl.Error:
+				continue
+			worksize = device.worksize
+			smallest = min(32, worksize)
+			while worksize >= smallest:
+				device.worksize = worksize
+				rate = self.measure_kernel(device)
+				if rate > best[0]:
+					best = (rate, self.settings(device))
+				worksize /= 2
+		if not best[1]:
+			say_line('%s: no kernel variant could be built, using the default settings', device.name)
+			return None
+		say_line('%s: %s, %.1f MH/s', (device.name, ', '.join(['%s=%s' % item for item in sorted(best[1].items())]), best[0] / 1e6))
+		return best[1]
+
+	def measure_kernel(self, device):
+		queue = cl.CommandQueue(device.context, properties=cl.command_queue_properties.PROFILING_ENABLE)
+		output = np.zeros(device.output_size + 1, np.uint32)
+		buffer = cl.Buffer(device.context, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR, hostbuf=output)
+		threads = device.worksize * (0x400000 // device.worksize)
+		args = [np.uint32(0)] * 14 + [pack('I', 0)] + [np.uint32(0)] * 6 + [buffer]
+		times = []
+		# the first launch pays for warming up the device and is not counted
+		for i in xrange(4):
+			event = device.miner.search(queue, (threads,), (device.worksize,), *args)
+			event.wait()
+			times.append((event.profile.end - event.profile.start) * 1e-9)
+		return threads * if_else(device.vectors, 2, 1) / min(times[1:])
 
+	def kernel_source(self):
 		kernel_file = open('phatk.cl', 'r')
 		kernel = kernel_file.read()
 		kernel_file.close()
-		m = md5(); m.update(''.join([self.device.platform.name, self.device.platform.version, self.device.name, self.defines, kernel]))
-		cache_name = '%s.elf' % m.hexdigest()
-		binary = None
-		try:
-			binary = open(cache_name, 'rb')
-			self.miner = cl.Program(self.context, [self.device], [binary.read()]).build(self.defines)
-		except (IOError, cl.LogicError):
-			self.miner = cl.Program(self.context, kernel).build(self.defines)
-			if (self.defines.find('-DBITALIGN') != -1):
-				patchedBinary = patch(self.miner.binaries[0])
-				self.miner = cl.Program(self.context, [self.device], [patchedBinary]).build(self.defines)
-			binaryW = open(cache_name, 'wb')
-			binaryW.write(self.miner.binaries[0])
-			binaryW.close()
-		finally:
-			if binary: binary.close()
-
-		if (self.options.worksize == -1):
-			self.options.worksize = self.miner.search.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, self.device)
+		return kernel
+
+	def fingerprint(self, device, defines, kernel):
+		m = md5(); m.update(''.join([device.device.platform.name, device.device.platform.version, device.device.name, defines, kernel]))
+		return m.hexdigest()
+
+	def environment(self, device):
+		# a new pyopencl or driver can not be trusted with binaries built by the old one
+		return ' '.join([cl.VERSION_TEXT, device.device.platform.version, device.device.driver_version])
+
+	def load_kernel(self, device):
+		if not device.context:
+			device.context = cl.Context([device.device], None, None)
+
+		kernel = self.kernel_source()
+		device.fingerprint = self.fingerprint(device, device.defines, kernel)
+		binary = self.kernel_cache.get(device.fingerprint, self.environment(device))
+		if binary:
+			try:
+				device.miner = cl.Program(device.context, [device.device], [binary]).build(device.defines)
+			except cl.Error:
+				self.kernel_cache.discard(device.fingerprint)
+				binary = None
+		if not binary:
+			device.miner = cl.Program(device.context, kernel).build(device.defines)
+			if device.bfi_int:
+				patchedBinary = patch(device.miner.binaries[0])
+				device.miner = cl.Program(device.context, [device.device], [patchedBinary]).build(device.defines)
+			self.kernel_cache.put(device.fingerprint, self.environment(device), device.miner.binaries[0])
+
+		if (device.worksize == -1):
+			device.worksize = device.miner.search.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device.device)
+
+	def warm_cache(self):
+		# builds every variant of every device ahead of time, the mining threads then only read binaries
+		tasks = Queue()
+		for device in self.devices:
+			if not device.device: continue
+			device.context = cl.Context([device.device], None, None)
+			for variant in self.variants(device):
+				build = copy(device)
+				self.configure(build, build.worksize, *variant)
+				tasks.put(build)
+		count = tasks.qsize()
+		start = time()
+		threads = []
+		for i in xrange(min(cpu_count(), count)):
+			thread = Thread(target=self.warm_thread, args=(tasks,))
+			thread.start()
+			threads.append(thread)
+		for thread in threads:
+			thread.join()
+		say_line('%d kernels built or found in %s in %.1f s', (count, self.options.kernel_cache, time() - start))
+
+	def warm_thread(self, tasks):
+		while True:
+			try:
+				build = tasks.get(False)
+			except Empty:
+				return
+			try:
+				self.load_kernel(build)
+			except cl.Error as e:
+				say_line('%s: building %s failed: %s', (build.name, build.defines, e))
@@ -0,0 +1,160 @@
+from multiprocessing import Pool, cpu_count
+from sha256 import *
+from time import time
+
+# Second-hash constants folded the same way as in phatk.cl
+H = np.array([0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0xfc08884d, 0xec9fcd13], np.uint32)
+L = np.uint32(0x198c7e2a2 & 0xffffffff)
+FOUND = np.uint32(-0xec9fcd13 & 0xffffffff)
+
+def s0(x):
+	return rot(x, 30) ^ rot(x, 19) ^ rot(x, 10)
+
+def s1(x):
+	return rot(x, 26) ^ rot(x, 21) ^ rot(x, 7)
+
+def ch(x, y, z):
+	return z ^ (x & (y ^ z))
+
+def ma(x, y, z):
+	return (x & y) | (z & (x | y))
+
+def W(w, x):
+	return (rot(w[x-2], 15) ^ rot(w[x-2], 13) ^ (w[x-2] >> 10)) + w[x-7] + (rot(w[x-15], 25) ^ rot(w[x-15], 14) ^ (w[x-15] >> 3)) + w[x-16]
+
+def sharound(v, w, n):
+	t1 = v[(135 - n) % 8] + w[n] + s1(v[(132 - n) % 8]) + ch(v[(132 - n) % 8], v[(133 - n) % 8], v[(134 - n) % 8]) + K[n % 64]
+	v[(131 - n) % 8] = v[(131 - n) % 8] + t1
+	v[(135 - n) % 8] = t1 + s0(v[(128 - n) % 8]) + ma(v[(129 - n) % 8], v[(130 - n) % 8], v[(128 - n) % 8])
+
+def search(args, base, count, vectors=False):
+	nonces = np.uint32(base) + np.arange(count, dtype=np.uint32)
+	if vectors:
+		nonces = np.concatenate(((nonces << 1), (nonces << 1) + 1))
+
+	# Everything that gets rotated has to be an array, rotating NumPy scalars promotes them to int64
+	full = lambda x: np.full(nonces.shape, x, np.uint32)
+	(state0, state1, state2, state3, state4, state5, state6, state7,
+		B1, C1, D1, F1, G1, H1, W2, W16, W17, PreVal4, T1, target) = [full(x) for x in args]
+
+	v = [None] * 8
+	w = [np.uint32(0)] * 124
+	v[1] = B1; v[2] = C1; v[5] = F1; v[6] = G1
+
+	w[2] = W2
+	w[3] = nonces
+	v[4] = nonces + PreVal4
+	w[4] = full(0x80000000)
+	w[15] = full(0x00000280)
+	w[16] = W16
+	w[17] = W17
+	for x in xrange(18, 31):
+		w[x] = W(w, x)
+
+	# Round 3
+	v[0] = v[4] + state0
+	v[4] = v[4] + T1
+
+	# Round 4
+	v[3] = s1(v[0]) + ch(v[0], v[1], v[2]) + D1 + 0xb956c25b
+	v[7] = v[3] + H1
+	v[3] = v[3] + s0(v[4]) + ma(v[5], v[6], v[4])
+
+	# Round 5
+	t1 = s1(v[7]) + ch(v[7], v[0], v[1]) + C1 + K[5]
+	v[2] = t1 + s0(v[3]) + ma(v[4], v[5], v[3])
+	v[6] = t1 + G1
+
+	for n in xrange(6, 64):
+		if n > 30:
+			w[n] = W(w, n)
+		sharound(v, w, n)
+
+	state = (state0, state1, state2, state3, state4, state5, state6, state7)
+	for i in xrange(8):
+		w[64 + i] = v[i] + state[i]
+	w[72] = full(0x80000000)
+	w[79] = full(0x00000100)
+
+	v = [H[0], H[1], H[2], w[64] + L, H[3], H[4], H[5], w[64] + H[6]]
+	for n in xrange(65, 124):
+		if n > 79:
+			w[n] = W(w, n)
+		sharound(v, w, n)
+
+	# Round 124
+	v[7] = v[7] + v[3] + W(w, 124) + s1(v[0]) + ch(v[0], v[1], v[2])
+
+	# Round 125, the second hash word has to meet the share target too, K[60] was left out of round 124
+	e = v[7] + K[60]
+	v[6] = v[6] + v[2] + K[61] + H[5] + W(w, 125) + s1(e) + ch(e, v[0], v[1])
+
+	return nonces[(v[7] == FOUND) & (bytereverse(v[6]) <= target)]
+
+def search_chunk(chunk):
+	start = time()
+	nonces = search(*chunk)
+	return (nonces, start, time())
+
+class CpuEngine(object):
+	def __init__(self, output_size, vectors=False, processes=None):
+		self.output_size = output_size
+		self.vectors = vectors
+		self.processes = processes or cpu_count()
+		self.pool = Pool(self.processes)
+
+	def search(self, queue, global_size, local_size, *args):
+		output = args[-1]
+		base = args[14]
+		if isinstance(base, str): base = unpack('I', base)[0]
+		args = args[:14] + args[15:-1]
+
+		threads = global_size[0]
+		size = -(-threads // self.processes)
+		chunks = [(args, uint32(base + offset), min(size, threads - offset), self.vectors) for offset in xrange(0, threads, size)]
+		return CpuEvent(self.pool.map_async(search_chunk, chunks), output, self.output_size)
+
+	def kernel(self):
+		return CpuKernel(self)
+
+	def close(self):
+		self.pool.terminate()
+		self.pool.join()
+
+class CpuKernel(object):
+	# stands in for a pyopencl kernel, arguments are bound once and then updated one at a time
+	def __init__(self, engine):
+		self.engine = engine
+		self.args = []
+
+	def set_args(self, *args):
+		self.args = list(args)
+
+	def set_arg(self, index, value):
+		self.args[index] = value
+
+	def enqueue(self, global_size, local_size):
+		return self.engine.search(None, global_size, local_size, *self.args)
+
+class CpuEvent(object):
+	# stands in for the pyopencl event of a kernel launch, output is filled in by wait()
+	def __init__(self, result, output, output_size):
+		self.result = result
+		self.output = output
+		self.output_size = output_size
+		# execution times in nanoseconds, like the profiling info of an OpenCL event
+		self.profile = Object()
+		self.profile.queued = self.profile.start = self.profile.end = int(time() * 1e9)
+
+	def wait(self):
+		if self.result:
+			chunks = self.result.get()
+			# appended to a dense list like the kernel does, output[output_size] counts them
+			for (nonces, start, end) in chunks:
+				for nonce in nonces:
+					count = self.output[self.output_size]
+					if count < self.output_size: self.output[count] = nonce
+					self.output[self.output_size] = count + 1
+			self.profile.start = int(min([start for (nonces, start, end) in chunks]) * 1e9)
+			self.profile.end = int(max([end for (nonces, start, end) in chunks]) * 1e9)
+			self.result = None
@@ -1,13 +1,17 @@
+from Queue import Queue, Empty
+from ShareJournal import ShareJournal
 from Transport import Transport
 from base64 import b64encode
+from collections import deque
 from json import dumps, loads
 from log import *
 from sha256 import *
-from threading import Thread
+from threading import Event, Thread
 from time import sleep, time
 from urlparse import urlsplit
 from util import *
 import httplib
+import re
 import traceback
 
 import pools
@@ -18,28 +22,56 @@ class RPCError(Exception): pass
 class HttpTransport(Transport):
 	def __init__(self, miner):
 		self.connection = self.lp_connection = None
+		self.standby = {}
+		self.long_poll_ready = Event()
 		super(HttpTransport, self).__init__(miner)
 		self.timeout = 5
 		self.long_poll_timeout = 3600
 		self.long_poll_max_askrate = 60 - self.timeout
+		self.long_poll_min_interval = 1
 		self.max_redirects = 3
 
 		self.postdata = {'method': 'getwork', 'id': 'json'}
 
 		self.long_poll_active = False
 		self.long_poll_url = ''
+		self.switched = False
+
+		self.batch_submit = self.config.batch_submit
+		self.single_submit = set()
+		self.submit_queue = Queue()
+		self.submit_connections = {}
+		self.submit_times = deque(maxlen=100)
+		self.journal = ShareJournal(self.config.share_journal)
+		self.unsent = {}
+		self.compact_block = None
 
 	def loop(self):
 		self.should_stop = False
 		thread = Thread(target=self.long_poll_thread)
 		thread.daemon = True
 		thread.start()
+		thread = Thread(target=self.askrate_thread)
+		thread.daemon = True
+		thread.start()
+		for i in xrange(self.config.submit_connections):
+			thread = Thread(target=self.submit_thread)
+			thread.daemon = True
+			thread.start()
+		if self.config.standby:
+			thread = Thread(target=self.standby_thread)
+			thread.daemon = True
+			thread.start()
 
+		self.wake()
 		while True:
+			# woken up by new results, work requests from the miner and the askrate timer
+			self.wakeup.wait()
+			self.wakeup.clear()
 			if self.should_stop: return
 			try:
 				with self.lock:
-					update = self.update = (self.update or (time() - self.last_work) > if_else(self.long_poll_active, self.long_poll_max_askrate, self.config.askrate))
+					update = self.update = (self.update or (time() - self.last_work) > self.askrate())
 				if update:
 					work = self.getwork()
 					if self.update:
@@ -49,17 +81,45 @@ class HttpTransport(Transport):
 					result = self.result_queue.get(False)
 					with self.lock:
 						rv = self.send(result)
-				sleep(1)
+
+				self.refill()
+				self.prefetch()
 			except Exception:
 				say_line("Unexpected error:")
 				traceback.print_exc()
 
+	def prefetch(self):
+		# after switching to a standby job a getwork of our own brings the pool's long poll, rolling and host headers
+		while not self.update and (self.prefetched() < self.config.prefetch or self.switched):
+			self.switched = False
+			job = self.decode(self.getwork())
+			if self.should_stop or not job: return
+			if job.header[25:29] != self.last_block:
+				# the block changed under us, let the main loop queue fresh work
+				self.update = True
+				self.wake()
+				return
+			self.process(job)
+			self.add_prefetched(job)
+
+	def askrate(self):
+		return if_else(self.long_poll_active, self.long_poll_max_askrate, self.config.askrate)
+
+	def askrate_thread(self):
+		while True:
+			if self.should_stop: return
+			with self.lock:
+				# retry failed getworks every second, otherwise sleep until the next one is due
+				delay = if_else(self.update, 1, self.last_work + self.askrate() - time())
+			sleep(max(delay, 0.1))
+			self.wake()
+
 	def connect(self, proto, host, timeout):
 		if proto == 'https': connector = httplib.HTTPSConnection
 		else: connector = httplib.HTTPConnection
 		return connector(host, strict=True, timeout=timeout)
 
-	def request(self, connection, url, headers, data=None):
+	def request(self, connection, url, headers, data=None, process_headers=True, roll=None):
 		result = response = None
 		try:
 			if data: connection.request('POST', url, data, headers)
@@ -74,23 +134,38 @@ class HttpTransport(Transport):
 				connection.request('GET', url, headers=headers)
 				response = connection.getresponse();
 				r -= 1
-			self.long_poll_url = response.getheader('X-Long-Polling', '')
-			self.miner.update_time = bool(response.getheader('X-Roll-NTime', ''))
-			hostList = response.getheader('X-Host-List', '')
-			if (not self.config.nsf) and hostList: self.add_servers(loads(hostList))
+			if process_headers:
+				self.set_long_poll_url(response.getheader('X-Long-Polling', ''))
+				(self.miner.update_time, self.roll_expire) = self.roll_headers(response)
+				hostList = response.getheader('X-Host-List', '')
+				if (not self.config.nsf) and hostList: self.add_servers(loads(hostList))
+			if roll is not None:
+				roll[:] = self.roll_headers(response)
 			result = loads(response.read())
-			if result['error']:	raise RPCError(result['error']['message'])
+			# batch requests get a list of responses, each with its own error
+			if isinstance(result, dict) and result['error']: raise RPCError(result['error']['message'])
 			return (connection, result)
 		finally:
 			if not result or not response or (response.version == 10 and response.getheader('connection', '') != 'keep-alive') or response.getheader('connection', '') == 'close':
 				connection.close()
 				connection = None
 
+	def roll_headers(self, response):
+		roll_ntime = response.getheader('X-Roll-NTime', '')
+		# expire=N limits how many seconds the work may be rolled
+		expire = re.search(r'expire=(\d+)', roll_ntime)
+		if expire: expire = int(expire.group(1))
+		return [bool(roll_ntime) and roll_ntime.lower() not in ('n', 'false'), expire]
+
 	def getwork(self, data=None):
 		if not data:
 			previous_best_pool = self.best_pools[0]
-			self.best_pools = self.pools.get_best_pools()
-			self.servers = pools.get_servers(self.best_pools)
+			best_pools = self.pools.get_best_pools()
+			if best_pools != self.best_pools:
+				# rebuilding the list every time would drop the X-Host-List servers
+				self.best_pools = best_pools
+				self.servers = pools.get_servers(self.best_pools)
+				self.user_servers = list(self.servers)
 
 			if previous_best_pool != self.best_pools[0]:
 				say_line("Switching to {0} with utility {1:.3f}".format(self.best_pools[0].name, self.best_pools[0].utility), show_server=False)
@@ -100,21 +175,27 @@ class HttpTransport(Transport):
 					say_line('  {0:15}: {1:.3f}'.format(pool.name, pool.utility), show_server=False)
 
 				self.set_server(self.servers[0])
-				self.connection = None
+				if self.queue_standby(): return
 
 		save_server = None
 		try:
 			if self.server != self.servers[0] and self.config.failback > 0:
-				if self.failback_getwork_count >= self.config.failback:
+				# a primary server that answers its probes is failed back to right away
+				if self.failback_getwork_count >= self.config.failback or self.alive(self.servers[0]):
 					save_server = self.server
 					say_line("Attempting to fail back to primary server")
 					self.set_server(self.servers[0])
+					if self.queue_standby():
+						self.failback_getwork_count = 0
+						return
 				self.failback_getwork_count += 1
 			if not self.connection:
 				self.connection = self.connect(self.proto, self.host, self.timeout)
 			self.postdata['params'] = if_else(data, [data], [])
-			(self.connection, result) = self.request(self.connection, '/', self.headers, dumps(self.postdata))
+			with self.miner.metrics.timer('getwork', pool=self.server[4]):
+				(self.connection, result) = self.request(self.connection, '/', self.headers, dumps(self.postdata))
 			self.errors = 0
+			self.retry_shares(self.server)
 			if self.server == self.servers[0]:
 				self.backup_server_index = 1
 				self.failback_getwork_count = 0
@@ -125,6 +206,8 @@ class HttpTransport(Transport):
 		except RPCError as e:
 			say('%s', e)
 		except (IOError, httplib.HTTPException, ValueError):
+			with self.lock:
+				if self.server in self.standby: self.standby[self.server].alive = False
 			if save_server:
 				self.failback_attempt_count += 1
 				self.set_server(save_server)
@@ -133,7 +216,14 @@ class HttpTransport(Transport):
 				return
 			say('Problems communicating with bitcoin RPC %s %s', (self.errors, self.config.tolerance))
 			self.errors += 1
-			if self.errors > self.config.tolerance + 1:
+			# with a live standby there is no point in waiting for more errors
+			backup = self.live_backup()
+			if backup:
+				self.errors = 0
+				say_line('Failing over to %s', backup[4])
+				self.set_server(backup)
+				self.queue_standby()
+			elif self.errors > self.config.tolerance + 1:
 				self.errors = 0
 				if self.backup_server_index >= len(self.servers):
 					say_line("No more backup pools left. Using primary and starting over.")
@@ -144,16 +234,253 @@ class HttpTransport(Transport):
 					self.backup_server_index += 1
 				self.set_server(pool)
 
+	def standby_thread(self):
+		# keeps connections, a recent job and a latency measurement ready for the next pools in line
+		while not self.should_stop:
+			with self.lock:
+				servers = [server for server in self.servers if server != self.server][:self.config.standby]
+				for server in self.standby.keys():
+					if server not in servers and server != self.server:
+						standby = self.standby.pop(server)
+						if standby.connection: standby.connection.close()
+			for server in servers:
+				if self.should_stop: return
+				self.probe(server)
+			sleep(self.config.probe_interval)
+
+	def probe(self, server):
+		with self.lock:
+			standby = self.standby.get(server)
+			if not standby:
+				standby = self.standby[server] = Object()
+				standby.connection = standby.alive = None
+			(connection, standby.connection) = (standby.connection, None)
+		start = time()
+		job = None
+		try:
+			if not connection:
+				connection = self.connect(server[0], server[3], self.timeout)
+			# the standby pool's own rolling headers apply to its work, not the current pool's
+			roll = []
+			(connection, result) = self.request(connection, '/', self.server_headers(server), dumps({'method': 'getwork', 'params': [], 'id': 'json'}), False, roll)
+			job = self.decode(result['result'], server, roll)
+		except (IOError, httplib.HTTPException, ValueError, KeyError, NotAuthorized, RPCError):
+			if connection: connection.close()
+			connection = None
+		self.miner.metrics.observe('probe', time() - start, pool=server[4])
+		if job: self.retry_shares(server)
+		with self.lock:
+			if standby.alive is not False and not job:
+				say_line('%s does not respond to probes', server[4])
+			standby.alive = bool(job)
+			standby.latency = time() - start
+			if job:
+				# the freshest job is the one a switch would start on
+				job.fetched = time()
+				jobs = self.prefetched_jobs.setdefault(server, deque())
+				jobs.appendleft(job)
+				while len(jobs) > max(self.config.prefetch, 1): jobs.pop()
+			if standby.connection or self.standby.get(server) is not standby:
+				# switched to this server or dropped it while probing
+				if connection: connection.close()
+			else:
+				standby.connection = connection
+
+	def alive(self, server):
+		with self.lock:
+			standby = self.standby.get(server)
+			return bool(standby and standby.alive)
+
+	def live_backup(self):
+		with self.lock:
+			for server in self.servers:
+				if server != self.server and self.alive(server):
+					return server
+
+	def queue_standby(self):
+		# switching to a standby server needs neither a new connection nor a getwork round trip
+		with self.lock:
+			if not self.prefetched(): return False
+			self.queue_job(self.prefetched_jobs[self.server].popleft())
+			self.switched = True
+		self.wake()
+		return True
+
 	def send_internal(self, result, nonce):
 		data = ''.join([result.header.encode('hex'), pack('III', long(result.time), long(result.difficulty), long(nonce)).encode('hex'), '000000800000000000000000000000000000000000000000000000000000000000000000000000000000000080020000'])
-		accepted = self.getwork(data)
-		if accepted != None:
-			self.report(nonce, accepted)
+		(is_block, hash6, hash5) = self.sent[nonce]
+		record = {'id': data[:160], 'data': data, 'nonce': long(nonce), 'time': time(), 'server': list(result.server[3:5]), 'user': result.server[1],
+			'block': result.header[25:29].encode('hex'), 'is_block': is_block, 'hash6': hash6, 'hash5': hash5}
+		self.submit_queue.put((result.server, nonce, data, record))
+
+	def new_block(self):
+		# pending shares of older blocks are dropped, on startup those of the current block are sent again
+		block = self.last_block.encode('hex')
+		with self.lock:
+			# rewriting the journal is left to a submit thread, this runs with the lock held
+			self.compact_block = block
+			# shares that never reached their pool can not be accepted anymore
+			for server in set(self.unsent.values()):
+				self.lost_shares(server, self.unsent.values().count(server))
+			self.unsent = {}
+		self.resubmit(self.journal.pending(block))
+
+	def lost_shares(self, server, count):
+		if server != self.server:
+			self.switch_shares(server, 'lost', count)
+
+	def keep_unsent(self, server, shares):
+		with self.lock:
+			for nonce, data in shares:
+				self.unsent[data[:160]] = server
+
+	def retry_shares(self, server):
+		# shares that failed to reach a pool go out again once it answers
+		if not self.unsent: return
+		with self.lock:
+			ids = [id for id in self.unsent if self.unsent[id] == server]
+			for id in ids:
+				del self.unsent[id]
+		self.resubmit(self.journal.get(ids))
+
+	def resubmit(self, shares):
+		count = 0
+		for share in shares:
+			# a share only counts for the worker whose work it was found on
+			servers = [server for server in self.servers if list(server[3:5]) == share['server'] and server[1] == share.get('user')]
+			if not servers: continue
+			with self.lock:
+				self.remember(share['nonce'], (share['is_block'], share['hash6'], share['hash5']))
+			self.submit_queue.put((servers[0], share['nonce'], share['data'], None))
+			count += 1
+		if count:
+			say_line('Resubmitting %d share(s)', count)
+
+	def submit_thread(self):
+		while True:
+			shares = [self.submit_queue.get()]
+			if self.should_stop: return
+			if self.batch_submit:
+				try:
+					while True:
+						share = self.submit_queue.get(False)
+						# the stop sentinel ends the batch, the thread quits once it is sent
+						if not share: break
+						shares.append(share)
+				except Empty: pass
+
+			# journaled before they are sent, shares are not lost to an outage or a restart,
+			# this thread does it so a slow disk does not hold up the ones waiting for the lock
+			self.journal.add([record for server, nonce, data, record in shares if record])
+			with self.lock:
+				(block, self.compact_block) = (self.compact_block, None)
+			if block:
+				self.journal.compact(block)
+
+			servers = {}
+			for server, nonce, data, record in shares:
+				servers.setdefault(server, []).append((nonce, data))
+			for server, shares in servers.items():
+				if self.batch_submit and len(shares) > 1 and server not in self.single_submit:
+					done = self.submit(server, shares)
+					if done: continue
+					# None is a failed batch, False a pool that does not understand them
+					if done is False:
+						say_line('%s does not accept batch requests, submitting its shares one by one', server[4])
+						self.single_submit.add(server)
+				for share in shares:
+					self.submit(server, [share])
+			if self.should_stop: return
+
+	def submit(self, server, shares):
+		connection = self.get_submit_connection(server)
+		if len(shares) == 1:
+			postdata = {'method': 'getwork', 'params': [shares[0][1]], 'id': 'json'}
+		else:
+			postdata = [{'method': 'getwork', 'params': [data], 'id': i} for i, (nonce, data) in enumerate(shares)]
+		start = time()
+		try:
+			(connection, result) = self.request(connection, '/', self.server_headers(server), dumps(postdata), server == self.server)
+			if len(shares) == 1:
+				results = [result]
+			elif isinstance(result, list) and len(result) == len(shares):
+				results = sorted(result, key=lambda r: r['id'])
+			else:
+				return False
+		except NotAuthorized:
+			connection = None
+			say_line('Wrong username or password submitting share to %s', server[4])
+			self.lost_shares(server, len(shares))
+			return True
+		except RPCError as e:
+			connection = None
+			if len(shares) > 1: return False
+			say_line('%s', e)
+			self.journal.done([shares[0][1][:160]])
+			self.lost_shares(server, 1)
+			return True
+		except ValueError:
+			connection = None
+			if len(shares) > 1: return None
+			say_line('Problems submitting share to %s', server[4])
+			self.keep_unsent(server, shares)
+			return True
+		except (IOError, httplib.HTTPException):
+			connection = None
+			say_line('Problems submitting %d share(s) to %s', (len(shares), server[4]))
+			self.keep_unsent(server, shares)
+			return True
+		finally:
+			self.put_submit_connection(server, connection)
+
+		self.submit_times.append((time() - start) / len(shares))
+		self.miner.metrics.observe('submit', time() - start, pool=server[4])
+		self.journal.done([data[:160] for nonce, data in shares])
+		for (nonce, data), result in zip(shares, results):
+			if result['error']:
+				say_line('%s', result['error']['message'])
+				self.lost_shares(server, 1)
+			else:
+				with self.lock:
+					self.report(nonce, result['result'], server)
+		if self.config.verbose:
+			say_line('submitted %d share(s) in %.1f ms, %d queued', (len(shares), (time() - start) * 1000, self.submit_queue.qsize()))
+		return True
+
+	def submit_stats(self):
+		times = list(self.submit_times)
+		return (self.submit_queue.qsize(), sum(times) / max(len(times), 1), max(times or [0]))
+
+	def get_submit_connection(self, server):
+		with self.lock:
+			connections = self.submit_connections.setdefault(server, [])
+			if connections:
+				return connections.pop()
+		return self.connect(server[0], server[3], self.timeout)
+
+	def put_submit_connection(self, server, connection):
+		with self.lock:
+			connections = self.submit_connections.setdefault(server, [])
+			if connection and len(connections) < self.config.submit_connections:
+				connections.append(connection)
+			elif connection:
+				connection.close()
+
+	def server_headers(self, server):
+		user, pwd = server[1:3]
+		return {"User-Agent": self.user_agent, "Authorization": 'Basic ' + b64encode('%s:%s' % (user, pwd))}
+
+	def set_long_poll_url(self, url):
+		self.long_poll_url = url
+		if url: self.long_poll_ready.set()
+		else: self.long_poll_ready.clear()
 
 	def long_poll_thread(self):
 		last_host = None
 		while True:
-			sleep(1)
+			self.long_poll_ready.wait()
+			if self.should_stop:
+				return
 			url = self.long_poll_url
 			if url != '':
 				proto = self.proto
@@ -173,63 +500,53 @@ class HttpTransport(Transport):
 						last_host = host
 					
 					self.long_poll_active = True
-					(self.lp_connection, result) = self.request(self.lp_connection, url, self.headers)
+					start = time()
+					with self.miner.metrics.timer('long_poll', pool=self.server[4]):
+						(self.lp_connection, result) = self.request(self.lp_connection, url, self.headers)
 					self.long_poll_active = False
 					if self.should_stop:
 						return
 					self.queue_work(result['result'])
-					self.miner.stale = True
+					self.miner.set_stale()
 					if self.config.verbose:
 						say_line('long poll: new block %s%s', (result['result']['data'][56:64], result['result']['data'][48:56]))
+					# a long poll that answers right away must not be asked again right away
+					sleep(max(start + self.long_poll_min_interval - time(), 0))
 				except NotAuthorized:
 					say_line('long poll: Wrong username or password')
+					sleep(1)
 				except RPCError as e:
 					say_line('long poll: %s', e)
+					sleep(1)
 				except (IOError, httplib.HTTPException, ValueError):
 					say_line('long poll: IO error')
 					#traceback.print_exc()
 					self.close_lp_connection()
+					sleep(1)
 
 	def stop(self):
 		self.should_stop = True
 		self.close_lp_connection()
+		self.long_poll_ready.set()
+		self.wake()
+		for i in xrange(self.config.submit_connections):
+			self.submit_queue.put(None)
 
 	def set_server(self, server):
 		super(HttpTransport, self).set_server(server)
-		user, pwd = server[1:3]
-		self.headers = {"User-Agent": self.user_agent, "Authorization": 'Basic ' + b64encode('%s:%s' % (user, pwd))}
-		self.long_poll_url = ''
+		self.headers = self.server_headers(server)
+		self.set_long_poll_url('')
 		if self.connection:
 			self.connection.close()
 			self.connection = None
 		self.close_lp_connection()
+		with self.lock:
+			# probe() takes the connection out under the lock too, the two never share it
+			standby = self.standby.get(server)
+			if standby and standby.connection:
+				(self.connection, standby.connection) = (standby.connection, None)
 
 	def close_lp_connection(self):
 		if self.lp_connection:
 			self.lp_connection.close()
 			self.lp_connection = None
-
-	def decode(self, work):
-		if work:
-			job = Object()
-
-			if not 'target' in work:
-				work['target'] = 'ffffffffffffffffffffffffffffffffffffffffffffffffffffffff00000000'
-
-			binary_data = work['data'].decode('hex')
-			data0 = np.zeros(64, np.uint32)
-			data0 = np.insert(data0, [0] * 16, unpack('IIIIIIIIIIIIIIII', binary_data[:64]))
-
-			job.target     = np.array(unpack('IIIIIIII', work['target'].decode('hex')), dtype=np.uint32)
-			job.header     = binary_data[:68]
-			job.merkle_end = np.uint32(unpack('I', binary_data[64:68])[0])
-			job.time       = np.uint32(unpack('I', binary_data[68:72])[0])
-			job.difficulty = np.uint32(unpack('I', binary_data[72:76])[0])
-			job.state      = sha256(STATE, data0)
-			job.f          = np.zeros(8, np.uint32)
-			job.state2     = partial(job.state, job.merkle_end, job.time, job.difficulty, job.f)
-			job.targetQ    = 2**256 / int(''.join(list(chunks(work['target'], 2))[::-1]), 16)
-
-			calculateF(job.state, job.merkle_end, job.time, job.difficulty, job.f, job.state2)
-
-			return job
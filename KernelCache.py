@@ -0,0 +1,142 @@
+from contextlib import contextmanager
+from json import dump, load
+from log import *
+from threading import Lock
+from time import time
+import os
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+	import msvcrt
+
+class KernelCache(object):
+	# compiled kernels shared between devices, runs and instances, the index remembers sizes and last use
+	def __init__(self, directory, max_size):
+		self.directory = directory
+		self.max_size = max_size
+		self.lock = Lock()
+
+	def get(self, key, environment):
+		if not self.directory: return None
+		try:
+			with self.locked():
+				index = self.read_index()
+				entry = index.get(key)
+				if not entry: return None
+				binary = None
+				# binaries built by another pyopencl or driver version are rebuilt
+				if entry['environment'] == environment:
+					try:
+						with open(os.path.join(self.directory, entry['file']), 'rb') as f:
+							binary = f.read()
+						entry['used'] = time()
+					except IOError:
+						pass
+				if not binary:
+					self.remove(index, key)
+				self.write_index(index)
+				return binary
+		except (IOError, OSError) as e:
+			self.unavailable(e)
+
+	def put(self, key, environment, binary):
+		if not self.directory: return
+		try:
+			with self.locked():
+				index = self.read_index()
+				name = '%s.elf' % key
+				try:
+					self.write(name, binary)
+				except (IOError, OSError):
+					return
+				index[key] = {'file': name, 'size': len(binary), 'used': time(), 'environment': environment}
+				self.evict(index)
+				self.write_index(index)
+		except (IOError, OSError) as e:
+			self.unavailable(e)
+
+	def discard(self, key):
+		if not self.directory: return
+		try:
+			with self.locked():
+				index = self.read_index()
+				self.remove(index, key)
+				self.write_index(index)
+		except (IOError, OSError) as e:
+			self.unavailable(e)
+
+	def unavailable(self, e):
+		# the cache only saves time, kernels are built without it from here on
+		with self.lock:
+			if not self.directory: return
+			say_line('kernel cache %s can not be used, building kernels without it: %s', (self.directory, e))
+			self.directory = None
+
+	def evict(self, index):
+		# least recently used first, the newest entry always stays
+		entries = sorted(index.items(), key=lambda item: item[1]['used'])
+		size = sum([entry['size'] for key, entry in entries])
+		for key, entry in entries[:-1]:
+			if size <= self.max_size: break
+			size -= entry['size']
+			self.remove(index, key)
+
+	def remove(self, index, key):
+		entry = index.pop(key, None)
+		if entry:
+			try:
+				os.remove(os.path.join(self.directory, entry['file']))
+			except OSError:
+				pass
+
+	def read_index(self):
+		try:
+			with open(os.path.join(self.directory, 'index.json'), 'r') as f:
+				return load(f)
+		except (IOError, ValueError):
+			return {}
+
+	def write_index(self, index):
+		try:
+			self.write('index.json', index)
+		except (IOError, OSError):
+			pass
+
+	def write(self, name, data):
+		# readers only ever see complete files
+		path = os.path.join(self.directory, name)
+		temp = '%s.%d.tmp' % (path, os.getpid())
+		with open(temp, 'wb') as f:
+			if isinstance(data, dict):
+				dump(data, f, indent=1, sort_keys=True)
+			else:
+				f.write(data)
+		if os.name == 'nt' and os.path.exists(path):
+			os.remove(path)
+		os.rename(temp, path)
+
+	@contextmanager
+	def locked(self):
+		# the thread lock guards this process, the file lock other instances
+		with self.lock:
+			if not os.path.isdir(self.directory):
+				try:
+					os.makedirs(self.directory)
+				except OSError:
+					pass
+			with open(os.path.join(self.directory, 'lock'), 'a') as f:
+				if fcntl:
+					fcntl.flock(f, fcntl.LOCK_EX)
+				else:
+					f.seek(0)
+					msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+				try:
+					yield
+				finally:
+					if fcntl:
+						fcntl.flock(f, fcntl.LOCK_UN)
+					else:
+						f.seek(0)
+						msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
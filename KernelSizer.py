@@ -0,0 +1,36 @@
+from math import exp, log
+
+class KernelSizer(object):
+	# PI controller in log space, sizes launches so one takes 1/frames seconds of device time
+	def __init__(self, unit, frame, limit, rate=None, kp=0.3, ki=0.4, smoothing=0.3):
+		self.unit = unit
+		self.frame = frame
+		self.limit = max(unit * (limit // unit), unit)
+		self.kp = kp
+		self.ki = ki
+		self.smoothing = smoothing
+		self.error = 0.0
+		self.per_thread = None
+		self.threads = float(rate * frame if rate else unit * 10)
+		self.threads = min(max(self.threads, unit), self.limit)
+
+	def size(self):
+		return max(self.unit * int(self.threads / self.unit), self.unit)
+
+	def update(self, threads, seconds):
+		if threads <= 0 or seconds <= 0: return self.size()
+		# launches already in flight ran with older sizes, so control on the time per thread
+		per_thread = seconds / threads
+		if self.per_thread is None:
+			self.per_thread = per_thread
+		else:
+			self.per_thread += self.smoothing * (per_thread - self.per_thread)
+		error = log(self.frame / (self.per_thread * self.threads))
+		self.threads *= exp(self.kp * (error - self.error) + self.ki * error)
+		self.threads = min(max(self.threads, self.unit), self.limit)
+		self.error = error
+		return self.size()
+
+	def rate(self):
+		if self.per_thread: return 1 / self.per_thread
+
@@ -0,0 +1,121 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from json import dumps
+from threading import Lock, Thread
+from time import time
+
+PREFIX = 'poclbm_'
+
+class Timer(object):
+	def __init__(self, metrics, name, labels):
+		self.metrics = metrics
+		self.name = name
+		self.labels = labels
+
+	def __enter__(self):
+		self.start = time()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.metrics.observe(self.name, time() - self.start, **self.labels)
+
+class Metrics(object):
+	def __init__(self):
+		self.lock = Lock()
+		self.timings = {}
+		self.counters = {}
+		self.gauges = {}
+
+	def observe(self, name, seconds, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			timing = self.timings.setdefault(key, [0, 0.0, 0.0, 0.0])
+			timing[0] += 1
+			timing[1] += seconds
+			timing[2] = max(timing[2], seconds)
+			timing[3] = seconds
+
+	def timer(self, name, **labels):
+		return Timer(self, name, labels)
+
+	def count(self, name, n=1, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + n
+
+	def set(self, name, value, **labels):
+		with self.lock:
+			self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+	def snapshot(self):
+		result = {'timings': {}, 'counters': {}, 'gauges': {}}
+		with self.lock:
+			for (name, labels), (count, total, maximum, last) in self.timings.items():
+				result['timings'].setdefault(name, []).append({'labels': dict(labels), 'count': count, 'sum': total, 'max': maximum, 'last': last})
+			for (name, labels), value in self.counters.items():
+				result['counters'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+			for (name, labels), value in self.gauges.items():
+				result['gauges'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+		return result
+
+	def prometheus(self):
+		snapshot = self.snapshot()
+		lines = []
+		for name, samples in sorted(snapshot['timings'].items()):
+			lines.append('# TYPE %s%s_seconds summary' % (PREFIX, name))
+			for sample in samples:
+				lines.append('%s%s_seconds_count%s %d' % (PREFIX, name, labels(sample), sample['count']))
+				lines.append('%s%s_seconds_sum%s %r' % (PREFIX, name, labels(sample), sample['sum']))
+			lines.append('# TYPE %s%s_seconds_max gauge' % (PREFIX, name))
+			for sample in samples:
+				lines.append('%s%s_seconds_max%s %r' % (PREFIX, name, labels(sample), sample['max']))
+		for name, samples in sorted(snapshot['counters'].items()):
+			lines.append('# TYPE %s%s_total counter' % (PREFIX, name))
+			for sample in samples:
+				lines.append('%s%s_total%s %d' % (PREFIX, name, labels(sample), sample['value']))
+		for name, samples in sorted(snapshot['gauges'].items()):
+			lines.append('# TYPE %s%s gauge' % (PREFIX, name))
+			for sample in samples:
+				lines.append('%s%s%s %r' % (PREFIX, name, labels(sample), sample['value']))
+		return '\n'.join(lines) + '\n'
+
+def labels(sample):
+	if not sample['labels']: return ''
+	return '{%s}' % ','.join(['%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in sorted(sample['labels'].items())])
+
+#-------------------------------------------------------------------------------
+# Endpoint
+#-------------------------------------------------------------------------------
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path == '/metrics':
+			self.reply(self.server.metrics.prometheus(), 'text/plain; version=0.0.4')
+		elif self.path == '/metrics.json':
+			self.reply(dumps(self.server.metrics.snapshot()), 'application/json')
+		else:
+			self.send_error(404)
+
+	def reply(self, body, content_type):
+		self.send_response(200)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, metrics):
+		HTTPServer.__init__(self, address, MetricsHandler)
+		self.metrics = metrics
+
+	def start(self):
+		thread = Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
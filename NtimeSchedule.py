@@ -0,0 +1,57 @@
+from sha256 import *
+from threading import Lock
+from time import time
+
+# how many seconds a rolled ntime may run ahead of the clock
+ROLL_AHEAD = 10
+
+class NtimeSchedule(object):
+	# precalculated state2 and f for the upcoming ntime values of a rollable work unit,
+	# the ntime follows the clock and the devices keep to their own nonce ranges
+	def __init__(self, job, refill_queue, expire=None, batch=32):
+		self.state = [int(x) for x in job.state]
+		self.merkle_end = int(job.merkle_end)
+		self.difficulty = int(job.difficulty)
+		self.time = bytereverse(int(job.time))
+		self.start = time()
+		self.expires = None
+		if expire: self.expires = self.start + expire
+		self.next_offset = 1
+		self.refill_queue = refill_queue
+		self.batch = batch
+		self.lock = Lock()
+		self.variants = {}
+		self.refilling = False
+		self.fill()
+
+	def fill(self):
+		with self.lock:
+			start = self.next_offset
+			self.next_offset += self.batch
+		times = [bytereverse(uint32(self.time + start + i)) for i in xrange(self.batch)]
+		(state2, f) = precalculate_batch(self.state, self.merkle_end, times, self.difficulty)
+		with self.lock:
+			for i in xrange(self.batch):
+				self.variants[start + i] = (np.uint32(times[i]), state2[:, i].copy(), f[:, i].copy())
+			self.refilling = False
+
+	def elapsed(self, now):
+		return int(now - self.start)
+
+	def limit(self, now):
+		# the highest offset that may be searched now, -1 once the pool's rolling window is over
+		if self.expires and now > self.expires:
+			return -1
+		return self.elapsed(now) + ROLL_AHEAD
+
+	def get(self, offset):
+		# every device searches the same ntime, in its own part of the nonce space
+		while True:
+			with self.lock:
+				if self.next_offset - offset < self.batch / 2 and not self.refilling:
+					self.refilling = True
+					self.refill_queue.put(self)
+				if offset in self.variants:
+					return self.variants[offset]
+			# the refill is late, do it here rather than search old work again
+			self.fill()
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from json import dumps, loads
+from log import *
+from threading import Lock
+import os
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+	import msvcrt
+
+class ShareJournal(object):
+	# append-only record of found shares, each is written before it is submitted and marked once the pool answered,
+	# without a path the shares are only kept in memory
+	def __init__(self, path):
+		self.path = path
+		self.lock = Lock()
+		self.shares = OrderedDict()
+		self.file = None
+		if self.path and not self.lock_path():
+			say_line('%s is used by another miner, shares are only kept in memory', self.path)
+			self.path = None
+		if self.path:
+			self.load()
+
+	def lock_path(self):
+		# held for the life of the process, a second miner would rename its compacted journal over this one
+		try:
+			self.lock_file = open(self.path + '.lock', 'a')
+			if fcntl:
+				fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			else:
+				self.lock_file.seek(0)
+				msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+			return True
+		except (IOError, OSError):
+			return False
+
+	def load(self):
+		try:
+			with open(self.path, 'r') as f:
+				for line in f:
+					try:
+						record = loads(line)
+					except ValueError:
+						# the last line is torn when the process died while writing it
+						continue
+					if 'done' in record:
+						self.shares.pop(record['done'], None)
+					else:
+						self.shares[record['id']] = record
+		except IOError:
+			pass
+
+	def add(self, records):
+		with self.lock:
+			for record in records:
+				self.shares[record['id']] = record
+			if self.path and records:
+				self.append(records)
+
+	def done(self, ids):
+		with self.lock:
+			ids = [id for id in ids if self.shares.pop(id, None)]
+			if self.path and ids:
+				self.append([{'done': id} for id in ids])
+
+	def get(self, ids):
+		with self.lock:
+			return [self.shares[id] for id in ids if id in self.shares]
+
+	def pending(self, block):
+		with self.lock:
+			return [record for record in self.shares.values() if record['block'] == block]
+
+	def compact(self, block):
+		# shares for older blocks can not be accepted anymore, the rest is rewritten without the marks
+		with self.lock:
+			for id, record in self.shares.items():
+				if record['block'] != block:
+					del self.shares[id]
+			if not self.path: return
+			if self.file:
+				self.file.close()
+				self.file = None
+			temp = '%s.%d.tmp' % (self.path, os.getpid())
+			try:
+				with open(temp, 'w') as f:
+					f.write(''.join([dumps(record) + '\n' for record in self.shares.values()]))
+					f.flush()
+					os.fsync(f.fileno())
+				if os.name == 'nt' and os.path.exists(self.path):
+					os.remove(self.path)
+				os.rename(temp, self.path)
+			except (IOError, OSError):
+				pass
+
+	def append(self, records):
+		try:
+			if not self.file:
+				self.file = open(self.path, 'a')
+			self.file.write(''.join([dumps(record) + '\n' for record in records]))
+			self.file.flush()
+			os.fsync(self.file.fileno())
+		except (IOError, OSError):
+			pass
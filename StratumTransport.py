@@ -0,0 +1,215 @@
+from Transport import Transport
+from hashlib import sha256 as sha256d
+from json import dumps, loads
+from log import *
+from sha256 import *
+from threading import Thread
+from time import sleep, time
+from util import *
+import socket
+import traceback
+
+PADDING = '000000800000000000000000000000000000000000000000000000000000000000000000000000000000000080020000'
+
+def double_sha256(data):
+	return sha256d(sha256d(data).digest()).digest()
+
+def swap_words(data):
+	return ''.join([data[i:i+4][::-1] for i in xrange(0, len(data), 4)])
+
+def merkle_root(coinbase, branch):
+	root = double_sha256(coinbase)
+	for h in branch:
+		root = double_sha256(root + h.decode('hex'))
+	return root
+
+def difficulty_target(difficulty):
+	target = min(int(0xFFFF * 2 ** 208 / difficulty), 2 ** 256 - 1)
+	return ('%064x' % target).decode('hex')[::-1].encode('hex')
+
+class StratumTransport(Transport):
+	def __init__(self, miner):
+		self.socket = None
+		self.pending = {}
+		super(StratumTransport, self).__init__(miner)
+		self.timeout = 5
+		self.notify = None
+		self.extranonce1 = ''
+		self.extranonce2_size = 4
+		self.extranonce2 = 0
+		self.target = difficulty_target(1)
+		self.jobs = {}
+		self.request_id = 0
+
+	def loop(self):
+		self.should_stop = False
+		thread = Thread(target=self.read_thread)
+		thread.daemon = True
+		thread.start()
+
+		while True:
+			# woken up by new results, work requests from the miner and notifications from the pool
+			self.wakeup.wait()
+			self.wakeup.clear()
+			if self.should_stop: return
+			try:
+				with self.lock:
+					notify = self.notify
+				if self.update and notify:
+					self.queue_work(notify)
+
+				while not self.result_queue.empty():
+					result = self.result_queue.get(False)
+					with self.lock:
+						self.send(result)
+
+				self.refill()
+				self.prefetch()
+			except Exception:
+				say_line("Unexpected error:")
+				traceback.print_exc()
+
+	def prefetch(self):
+		# work is generated locally, so this never waits on the pool
+		while self.notify and self.prefetched() < self.config.prefetch:
+			job = self.decode(self.notify)
+			self.process(job)
+			self.add_prefetched(job)
+
+	def stop(self):
+		self.should_stop = True
+		self.close()
+		self.wake()
+
+	def decode(self, notify):
+		(job_id, prevhash, coinb1, coinb2, branch, version, nbits, ntime) = notify[:8]
+		with self.lock:
+			extranonce2 = '%0*x' % (self.extranonce2_size * 2, self.extranonce2)
+			self.extranonce2 = (self.extranonce2 + 1) % 2 ** (self.extranonce2_size * 8)
+			root = merkle_root((coinb1 + self.extranonce1 + extranonce2 + coinb2).decode('hex'), branch)
+			data = ''.join([version, prevhash, swap_words(root).encode('hex'), ntime, nbits, '00000000', PADDING])
+			job = super(StratumTransport, self).decode({'data': data, 'target': self.target})
+			self.jobs[job.header] = (job_id, extranonce2)
+			return job
+
+	def send_internal(self, result, nonce):
+		if result.header not in self.jobs:
+			# the pool told us to drop this job, or its connection is gone
+			del self.sent[nonce]
+			if result.server != self.server:
+				self.switch_shares(result.server, 'lost')
+			return
+		job_id, extranonce2 = self.jobs[result.header]
+		self.request('mining.submit', [self.server[1], job_id, extranonce2, pack('I', long(result.time)).encode('hex'), pack('I', long(nonce)).encode('hex')], nonce)
+
+	def request(self, method, params, nonce=None):
+		with self.lock:
+			self.request_id += 1
+			self.pending[self.request_id] = (method, nonce, time())
+			try:
+				self.socket.sendall(dumps({'id': self.request_id, 'method': method, 'params': params}) + '\n')
+			except (AttributeError, socket.error):
+				say_line('Problems sending %s to %s', (method, self.server[4]))
+				self.close()
+
+	def connect(self):
+		host, port = self.host.rsplit(':', 1)
+		# the timeout stays, a pool that stops reading must not hold up request() and its lock forever
+		self.socket = socket.create_connection((host, int(port)), self.timeout)
+		self.request('mining.subscribe', [self.user_agent])
+		self.request('mining.authorize', [self.server[1], self.server[2]])
+		return self.socket
+
+	def close(self):
+		with self.lock:
+			if self.socket:
+				self.socket.close()
+				self.socket = None
+			for method, nonce, sent in self.pending.values():
+				if nonce in self.sent: del self.sent[nonce]
+			self.pending = {}
+
+	def read_thread(self):
+		while not self.should_stop:
+			try:
+				sock = self.connect()
+				say_line('Connected to %s', self.server[4])
+				buffer = ''
+				while not self.should_stop:
+					try:
+						data = sock.recv(4096)
+					except socket.timeout:
+						# a quiet pool is not an error, only sends have to finish in time
+						continue
+					if not data: raise IOError('connection closed')
+					lines = (buffer + data).split('\n')
+					buffer = lines.pop()
+					for line in lines:
+						if line.strip(): self.handle(loads(line))
+			except (IOError, socket.error, ValueError):
+				if self.should_stop: return
+				say_line('Problems communicating with %s %s %s', (self.server[4], self.errors, self.config.tolerance))
+				self.close()
+				self.errors += 1
+				if self.errors > self.config.tolerance + 1:
+					self.errors = 0
+					if self.backup_server_index >= len(self.servers):
+						say_line("No more backup pools left. Using primary and starting over.")
+						pool = self.servers[0]
+						self.backup_server_index = 1
+					else:
+						pool = self.servers[self.backup_server_index]
+						self.backup_server_index += 1
+					self.set_server(pool)
+				sleep(1)
+
+	def handle(self, message):
+		method = message.get('method')
+		if method == 'mining.notify':
+			self.errors = 0
+			clean = message['params'][8]
+			with self.lock:
+				self.notify = message['params']
+				if clean or not self.jobs:
+					self.jobs = {}
+					self.prefetched_jobs = {}
+					self.update = True
+			if clean:
+				self.miner.set_stale()
+			self.wake()
+		elif method == 'mining.set_difficulty':
+			with self.lock:
+				target = difficulty_target(message['params'][0])
+				if target != self.target:
+					# prefetched jobs carry the old target, the pool would reject their shares
+					self.target = target
+					self.prefetched_jobs = {}
+					self.update = True
+			self.wake()
+		elif method == 'mining.set_extranonce':
+			with self.lock:
+				(self.extranonce1, self.extranonce2_size) = message['params'][:2]
+		elif message.get('id') in self.pending:
+			with self.lock:
+				(method, nonce, sent) = self.pending.pop(message['id'])
+				if method == 'mining.subscribe' and message['result']:
+					(self.extranonce1, self.extranonce2_size) = message['result'][1:3]
+				elif method == 'mining.authorize' and not message['result']:
+					self.failure('Wrong username or password')
+				elif method == 'mining.submit':
+					self.miner.metrics.observe('submit', time() - sent, pool=self.server[4])
+					if message['error']:
+						say_line('%s', (message['error'][1],))
+					self.report(nonce, bool(message['result']))
+
+	def set_server(self, server):
+		previous = self.server
+		super(StratumTransport, self).set_server(server)
+		with self.lock:
+			self.notify = None
+			self.jobs = {}
+			# submits still waiting for an answer go down with the old connection
+			lost = len([nonce for method, nonce, sent in self.pending.values() if method == 'mining.submit'])
+		self.close()
+		if previous and lost:
+			self.switch_shares(previous, 'lost', lost)
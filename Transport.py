@@ -1,19 +1,28 @@
+from NtimeSchedule import NtimeSchedule
 from Queue import Queue
+from collections import OrderedDict, deque
 from log import *
 from sha256 import *
+from threading import Event
 from time import time
 import log
 
 import pools
 
+# shares waiting for the pool's answer, the oldest are forgotten beyond this
+SENT_SIZE = 1000
+
 class Transport(object):
 	def __init__(self, miner):
 		self.lock = RLock()
 		self.result_queue = Queue()
+		self.refill_queue = Queue()
 		self.miner = miner
 		self.config = miner.options
 		self.update = True
 		self.last_work = 0
+		self.roll_expire = None
+		self.wakeup = Event()
 
 		self.backup_server_index = 1
 		self.errors = 0
@@ -26,7 +35,8 @@ class Transport(object):
 		self.true_target = None
 		self.last_block = ''
 
-		self.sent = {}
+		self.sent = OrderedDict()
+		self.prefetched_jobs = {}
 		
 		self.pools = pools.PoolManager()
 		self.best_pools = self.pools.get_best_pools()
@@ -48,12 +58,50 @@ class Transport(object):
 	def stop(self):
 		raise NotImplementedError
 
-	def decode(self, work):
-		raise NotImplementedError
+	def decode(self, work, server=None, roll=None):
+		# roll is whether and for how long the work may be rolled, by default what the current pool said
+		if work:
+			start = time()
+			job = Object()
+
+			if not 'target' in work:
+				work['target'] = 'ffffffffffffffffffffffffffffffffffffffffffffffffffffffff00000000'
+
+			binary_data = work['data'].decode('hex')
+			(merkle_end, ntime, difficulty) = unpack('III', binary_data[64:76])
+			state = midstate(binary_data[:64])
+			(state2, f) = precalculate(state, merkle_end, ntime, difficulty)
+
+			job.target     = np.array(unpack('IIIIIIII', work['target'].decode('hex')), dtype=np.uint32)
+			job.header     = binary_data[:68]
+			job.merkle_end = np.uint32(merkle_end)
+			job.time       = np.uint32(ntime)
+			job.difficulty = np.uint32(difficulty)
+			job.state      = np.array(state, np.uint32)
+			job.f          = np.array(f, np.uint32)
+			job.state2     = np.array(state2, np.uint32)
+			job.targetQ    = 2**256 / int(''.join(list(chunks(work['target'], 2))[::-1]), 16)
+			job.rolls      = None
+			job.offset     = 0
+			job.server     = server or self.server
+			(update_time, roll_expire) = roll or (self.miner.update_time, self.roll_expire)
+			if update_time:
+				job.rolls = NtimeSchedule(job, self.refill_queue, roll_expire)
+
+			self.miner.metrics.observe('decode', time() - start)
+			return job
 
 	def send_internal(self, result):
 		raise NotImplementedError
 
+	def failure(self, message):
+		log.flush()
+		print '\n%s' % message
+		self.miner.stop()
+
+	def wake(self):
+		self.wakeup.set()
+
 	def set_difficulty(self, difficulty):
 		self.difficulty = difficulty
 		bits = hex(difficulty)
@@ -68,31 +116,58 @@ class Transport(object):
 		if work:
 			if work.difficulty != self.difficulty:
 				self.set_difficulty(work.difficulty)
+			# the kernel only reports nonces whose second hash word meets this, targets below difficulty 1 let all through
+			work.target6 = np.uint32(if_else(work.target[7], 0xFFFFFFFF, work.target[6]))
 
 	def send(self, result):
-		for i in xrange(self.miner.output_size):
-			if result.nonce[i]:
-				h = hash(result.state, result.merkle_end, result.time, result.difficulty, result.nonce[i])
-				if h[7] != 0:
-					say_line('Verification failed, check hardware!')
-					self.miner.stop()
-				else:
-					self.miner.diff1_found(bytereverse(h[6]), result.target[6])
-					if belowOrEquals(h[:7], result.target[:7]):
-						is_block = belowOrEquals(h[:7], self.true_target[:7])
-						hash6 = pack('I', long(h[6])).encode('hex')
-						hash5 = pack('I', long(h[5])).encode('hex')
-						self.sent[result.nonce[i]] = (is_block, hash6, hash5)
-						self.send_internal(result, result.nonce[i])
-
-	def report(self, nonce, accepted):
+		nonces = result.nonce
+		if not len(nonces): return
+		# results go to the pool that issued their work, even after switching away from it
+		server = result.server = result.server or self.server
+		if result.header[25:29] != self.last_block:
+			self.miner.metrics.count('shares', len(nonces), result='stale', pool=server[4])
+			return
+
+		start = time()
+		h = hash_batch(result.state, result.merkle_end, result.time, result.difficulty, nonces)
+		valid = h[7] == 0
+		if not valid.all():
+			say_line('Verification failed, check hardware!')
+			self.miner.stop()
+		for i in np.flatnonzero(valid):
+			self.miner.diff1_found(bytereverse(h[6][i]), result.target[6])
+
+		shares = valid & belowOrEqualsBatch(h[:7], result.target[:7])
+		blocks = belowOrEqualsBatch(h[:7], self.true_target[:7])
+		self.miner.metrics.observe('verify', time() - start)
+		for i in np.flatnonzero(shares):
+			hash6 = pack('I', long(h[6][i])).encode('hex')
+			hash5 = pack('I', long(h[5][i])).encode('hex')
+			self.remember(nonces[i], (bool(blocks[i]), hash6, hash5))
+			self.send_internal(result, nonces[i])
+
+	def remember(self, nonce, share):
+		self.sent[nonce] = share
+		if len(self.sent) > SENT_SIZE:
+			self.sent.popitem(False)
+
+	def switch_shares(self, server, kept, count=1):
+		# shares found on work from a pool after switching away from it
+		self.miner.metrics.count('switch_shares', count, result=kept, pool=server[4])
+		if self.config.verbose:
+			say_line('%d share(s) for %s %s after switching pools', (count, server[4], kept))
+
+	def report(self, nonce, accepted, server=None):
+		if nonce not in self.sent: return
+		self.miner.metrics.count('shares', result=if_else(accepted, 'accepted', 'rejected'), pool=(server or self.server)[4])
+		if server and server != self.server:
+			self.switch_shares(server, 'kept')
 		is_block, hash6, hash5 = self.sent[nonce]
 		self.miner.share_found(if_else(is_block, hash6+hash5, hash6), accepted, is_block)
 		del self.sent[nonce]
 
 	def set_server(self, server):
-		self.clear_result_queue()
-		self.miner.stale = True
+		# the devices keep mining the old work until the new server sends some
 		self.update = True
 		self.server = server
 		proto, user, pwd, host, name = server
@@ -110,16 +185,46 @@ class Transport(object):
 			self.servers.insert(self.backup_server_index, server)
 
 	def queue_work(self, work):
-		work = self.decode(work)
+		self.queue_job(self.decode(work))
+
+	def queue_job(self, work):
 		self.process(work)
 		with self.lock:
-			self.miner.work_queue.put(work)
+			self.miner.queue_work(work)
 			if work:
 				self.update = False; self.last_work = time()
 				if self.last_block != work.header[25:29]:
 					self.last_block = work.header[25:29]
-					self.clear_result_queue()
+					self.new_block()
 
-	def clear_result_queue(self):
-		while not self.result_queue.empty():
-			self.result_queue.get(False)
+	def new_block(self):
+		pass
+
+	def prefetched(self):
+		with self.lock:
+			jobs = self.prefetched_jobs.setdefault(self.server, deque())
+			while jobs and not self.usable(jobs[0]):
+				jobs.popleft()
+			return len(jobs)
+
+	def add_prefetched(self, job):
+		job.fetched = time()
+		with self.lock:
+			self.prefetched_jobs.setdefault(self.server, deque()).append(job)
+
+	def next_work(self):
+		with self.lock:
+			job = None
+			if self.prefetched():
+				job = self.prefetched_jobs[self.server].popleft()
+		# refill in the background
+		self.wake()
+		return job
+
+	def usable(self, job):
+		return job.header[25:29] == self.last_block and time() - job.fetched < self.config.prefetch_age
+
+	def refill(self):
+		# ntime schedules running low, refilled here so mining threads do not have to
+		while not self.refill_queue.empty():
+			self.refill_queue.get(False).fill()
@@ -0,0 +1,591 @@
+#!/usr/bin/python
+
+from BitcoinMiner import BitcoinMiner
+from CpuEngine import CpuEngine, CpuKernel
+from HttpTransport import HttpTransport
+from NtimeSchedule import NtimeSchedule
+from Queue import Queue
+from StratumTransport import StratumTransport
+from decimal import Decimal
+from json import dump
+from optparse import OptionParser
+from sha256 import *
+from simulator import *
+from threading import Thread
+from time import sleep, time
+from util import *
+import log
+import math
+import os
+import platform
+import pools
+import scipy.integrate
+import shutil
+import sys
+import tempfile
+
+try:
+	import pyopencl as cl
+except ImportError:
+	cl = None
+
+def measure(function, args=(), min_time=1.0, number=1):
+	count = 0
+	start = now = time()
+	while now - start < min_time or count < 3:
+		for i in xrange(number):
+			function(*args)
+		count += number
+		now = time()
+	return (now - start) / count
+
+def genesis_job():
+	data = ''.join([GENESIS[i:i+4][::-1] for i in xrange(0, 80, 4)])
+	data0 = np.zeros(64, np.uint32)
+	data0[:16] = unpack('IIIIIIIIIIIIIIII', data[:64])
+
+	job = Object()
+	job.state = sha256(STATE, data0)
+	(job.merkle_end, job.time, job.difficulty, job.nonce) = [np.uint32(x) for x in unpack('IIII', data[64:80])]
+	job.target = np.array(unpack('IIIIIIII', DIFFICULTY_1.decode('hex')), dtype=np.uint32)
+	job.target6 = job.target[6]
+	job.f = np.zeros(8, np.uint32)
+	job.state2 = partial(job.state, job.merkle_end, job.time, job.difficulty, job.f)
+	job.server = None
+	job.rolls = None
+	calculateF(job.state, job.merkle_end, job.time, job.difficulty, job.f, job.state2)
+	return job
+
+def kernel_args(job, base):
+	state, state2, f = job.state, job.state2, job.f
+	return (state[0], state[1], state[2], state[3], state[4], state[5], state[6], state[7],
+		state2[1], state2[2], state2[3], state2[5], state2[6], state2[7],
+		pack('I', base),
+		f[0], f[1], f[2], f[3], f[4],
+		job.target[6])
+
+def share_result(job):
+	result = Object()
+	result.header = job.header
+	result.server = job.server
+	result.merkle_end = job.merkle_end
+	result.time = job.time
+	result.difficulty = job.difficulty
+	result.target = job.target
+	result.state = np.array(job.state)
+	result.nonce = result_output(genesis_job(), 1)
+	return result
+
+def result_output(job, found):
+	nonces = np.random.randint(1, 0xFFFFFFFF, found).astype(np.uint32)
+	nonces[0] = job.nonce
+	return nonces
+
+def kernel_binary(instructions=4096):
+	# a minimal AMD style kernel binary, an inner ELF with two .text sections
+	names = '\x00.text\x00.shstrtab\x00'
+	text = ''.join([pack('Q', if_else(i % 4, 0x0001a00000000000, i)) for i in xrange(instructions)])
+	start = 52 + len(names)
+	sections = [(0, 0, 0, 0), (7, 3, 52, len(names)), (1, 1, start, 8), (1, 1, start + 8, len(text))]
+	header = pack('QQHHIIIIIHHHHHH', 0x64010101464c457f, 0, 1, 3, 1, 0, 0, start + 8 + len(text), 0, 52, 0, 0, 40, len(sections), 1)
+	table = ''.join([pack('IIIIIIIIII', name, kind, 0, 0, offset, size, 0, 0, 0, 0) for name, kind, offset, size in sections])
+	return 'AMD' + header + names + '\x00' * 8 + text + table
+
+#-------------------------------------------------------------------------------
+# Host functions
+#-------------------------------------------------------------------------------
+
+def bench_micro(options):
+	job = genesis_job()
+	data0 = np.zeros(64, np.uint32)
+	data0[:16] = unpack('IIIIIIIIIIIIIIII', getwork_data(GENESIS).decode('hex')[:64])
+	f = np.zeros(8, np.uint32)
+	h = hash(job.state, job.merkle_end, job.time, job.difficulty, job.nonce)
+	binary = kernel_binary()
+	assert patch(binary) != binary
+
+	server = PoolServer()
+	transport = local_transport(server)
+	server.server_close()
+	work = server.getwork()
+
+	results = []
+	results.append(('micro/sha256.sha256', measure(sha256, (STATE, data0), options.min_time)))
+	results.append(('micro/sha256.hash', measure(hash, (job.state, job.merkle_end, job.time, job.difficulty, job.nonce), options.min_time)))
+	results.append(('micro/sha256.partial', measure(partial, (job.state, job.merkle_end, job.time, job.difficulty, f), options.min_time)))
+	results.append(('micro/sha256.calculateF', measure(calculateF, (job.state, job.merkle_end, job.time, job.difficulty, f, job.state2), options.min_time)))
+	results.append(('micro/util.belowOrEquals', measure(belowOrEquals, (h[:7], job.target[:7]), options.min_time, 100)))
+	results.append(('micro/util.bytereverse', measure(bytereverse, (0x1dac2b7c,), options.min_time, 1000)))
+	results.append(('micro/util.patch', measure(patch, (binary,), options.min_time)))
+	results.append(('micro/Transport.set_difficulty', measure(transport.set_difficulty, (job.difficulty,), options.min_time, 100)))
+	results.append(('micro/HttpTransport.decode', measure(transport.decode, (work,), options.min_time, 10)))
+
+	stdout, quiet = sys.stdout, log.quiet
+	sys.stdout, log.quiet = open(os.devnull, 'w'), False
+	try:
+		results.append(('micro/log.say', measure(log.say, ('[%.03f MH/s (~%d MH/s)]', (Decimal(1), 1)), options.min_time, 100)))
+		results.append(('micro/log.say_quiet', measure(log.say_quiet, ('[%.03f MH/s (~%d MH/s)]', (Decimal(1), 1)), options.min_time, 100)))
+		log.flush()
+	finally:
+		sys.stdout.close()
+		sys.stdout, log.quiet = stdout, quiet
+	return results
+
+#-------------------------------------------------------------------------------
+# Share verification
+#-------------------------------------------------------------------------------
+
+def verify_scalar(job, nonces):
+	shares = []
+	for nonce in nonces:
+		h = hash(job.state, job.merkle_end, job.time, job.difficulty, nonce)
+		if h[7] == 0 and belowOrEquals(h[:7], job.target[:7]):
+			shares.append(nonce)
+	return shares
+
+def verify_batch(job, nonces):
+	h = hash_batch(job.state, job.merkle_end, job.time, job.difficulty, nonces)
+	return list(nonces[(h[7] == 0) & belowOrEqualsBatch(h[:7], job.target[:7])])
+
+def bench_verify(options):
+	job = genesis_job()
+	results = []
+	for found in (1, 8, 64, 256):
+		nonces = result_output(job, found)
+		assert verify_scalar(job, nonces) == verify_batch(job, nonces) == [job.nonce]
+		scalar = measure(verify_scalar, (job, nonces), options.min_time)
+		batch = measure(verify_batch, (job, nonces), options.min_time)
+		results.append(('verify/scalar/%d' % found, scalar))
+		results.append(('verify/batch/%d' % found, batch))
+	return results
+
+#-------------------------------------------------------------------------------
+# Work decoding
+#-------------------------------------------------------------------------------
+
+def decode_numpy(work):
+	# decode as it was done before the integer precalculation
+	job = Object()
+	binary_data = work['data'].decode('hex')
+	data0 = np.zeros(64, np.uint32)
+	data0 = np.insert(data0, [0] * 16, unpack('IIIIIIIIIIIIIIII', binary_data[:64]))
+	job.target     = np.array(unpack('IIIIIIII', work['target'].decode('hex')), dtype=np.uint32)
+	job.header     = binary_data[:68]
+	job.merkle_end = np.uint32(unpack('I', binary_data[64:68])[0])
+	job.time       = np.uint32(unpack('I', binary_data[68:72])[0])
+	job.difficulty = np.uint32(unpack('I', binary_data[72:76])[0])
+	job.state      = sha256(STATE, data0)
+	job.f          = np.zeros(8, np.uint32)
+	job.state2     = partial(job.state, job.merkle_end, job.time, job.difficulty, job.f)
+	calculateF(job.state, job.merkle_end, job.time, job.difficulty, job.f, job.state2)
+	return job
+
+def bench_decode(options):
+	server = PoolServer()
+	transport = local_transport(server)
+	server.server_close()
+
+	works = []
+	for i in xrange(256):
+		server.new_block()
+		works.append(server.getwork())
+	def decode(decoder, works):
+		for work in works:
+			decoder(work)
+
+	for work in works:
+		old, new = decode_numpy(work), transport.decode(work)
+		for name in ('header', 'merkle_end', 'time', 'difficulty', 'state', 'state2', 'f', 'target'):
+			assert np.all(np.array(getattr(old, name)) == np.array(getattr(new, name)))
+
+	results = []
+	results.append(('decode/numpy', measure(decode, (decode_numpy, works[:16]), options.min_time) / 16))
+	# every header is new, so each one misses the midstate cache
+	results.append(('decode/int', measure(decode, (transport.decode, works), options.min_time) / len(works)))
+	# the same header again, so only the precalculation runs
+	results.append(('decode/int/cached', measure(decode, (transport.decode, works[:1] * 256), options.min_time) / 256))
+	return results
+
+def bench_roll(options):
+	job = genesis_job()
+	state = [int(x) for x in job.state]
+	schedule = NtimeSchedule(job, Queue(), batch=256)
+
+	def roll_inline():
+		job.time = bytereverse(bytereverse(job.time) + 1)
+		precalculate(state, int(job.merkle_end), int(job.time), int(job.difficulty))
+
+	return [('roll/inline', measure(roll_inline, (), options.min_time)),
+		('roll/batch', measure(schedule.fill, (), options.min_time) / schedule.batch)]
+
+#-------------------------------------------------------------------------------
+# Pool utility
+#-------------------------------------------------------------------------------
+
+def utility_quad(pool):
+	# the numerical integration pools.py used before the closed form
+	pool.update_data()
+	utility = 0.0
+	for block_time, probability in sorted(pools.get_pool_most_recent_block(pool.pident_name).items()):
+		progress = max(pool.get_shares(float(block_time)), 1.0) / pools.get_difficulty()
+		utility += probability * scipy.integrate.quad((lambda x: (math.exp(progress - x) / x)), progress, 100.0)[0]
+	return utility * (1 - pool.fee - pool.donation)
+
+def bench_utility(options):
+	progress = np.logspace(-7, math.log10(150), 200)
+	exact = np.array([scipy.integrate.quad((lambda x: (math.exp(p - x) / x)), p, 100.0)[0] for p in progress])
+	assert (abs(pools.expected_value(progress) - exact) <= 1e-8 * abs(exact)).all()
+
+	now = time()
+	classes = [pool for pool in pools._pool_class_map.values() if issubclass(pool, pools.ProportionalPool)]
+	data = {'rates': {}, 'most_recent_block': {}}
+	for i in xrange(len(classes)):
+		data['rates'][classes[i].pident_name] = 1e11 * (i + 1)
+		data['most_recent_block'][classes[i].pident_name] = dict([(str(now - 600 * (j + 1)), 0.05) for j in xrange(20)])
+	saved = (pools._difficulty, pools._pool_data)
+	(pools._difficulty, pools._pool_data) = ((1.5e6, now), (data, now))
+	try:
+		pool_list = [pool('user', 'password', 0.0, 0) for pool in classes]
+		quad = [utility_quad(pool) for pool in pool_list]
+		closed = [pool.utility for pool in pool_list]
+		# progress moves with the clock between the two evaluations
+		assert all([abs(a - b) <= 1e-4 * abs(a) for a, b in zip(quad, closed)])
+
+		def uncached():
+			for pool in pool_list:
+				pool.utility_cache = None
+			pools.update_utilities(pool_list)
+
+		results = []
+		results.append(('utility/quad', measure(lambda: [utility_quad(pool) for pool in pool_list], (), options.min_time)))
+		results.append(('utility/closed', measure(uncached, (), options.min_time)))
+		results.append(('utility/cached', measure(pools.update_utilities, (pool_list,), options.min_time)))
+	finally:
+		(pools._difficulty, pools._pool_data) = saved
+	return results
+
+def bench_refresh(options):
+	# the stats server answers slower than the measurement takes, so every read happens while fetches are in flight
+	server = StatsServer().start()
+	server.latency = options.min_time + 1
+	now = time()
+	classes = [pool for pool in pools._pool_class_map.values() if issubclass(pool, pools.ProportionalPool)]
+	for pool in classes:
+		server.pool_data['rates'][pool.pident_name] = 1e11
+		server.pool_data['most_recent_block'][pool.pident_name] = {str(now - 600): 1.0}
+	directory = tempfile.mkdtemp()
+	snapshot = os.path.join(directory, 'pools.snapshot')
+	saved = (pools._difficulty, pools._pool_data)
+	(pools._difficulty, pools._pool_data) = ((0, 0), ({}, 0))
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, 'w')
+	try:
+		refresher = pools.Refresher(server.url('/q/getdifficulty'), server.url('/api/pools/'), snapshot).start()
+		pool_list = [pool('user', 'password', 0.0, 0) for pool in classes]
+		results = [('refresh/read', measure(pools.update_utilities, (pool_list,), options.min_time))]
+		while not pools._pool_data[1]:
+			sleep(0.1)
+		refresher.stop()
+		assert pools.get_difficulty() == server.difficulty and os.path.exists(snapshot)
+
+		(pools._difficulty, pools._pool_data) = ((0, 0), ({}, 0))
+		results.append(('refresh/snapshot', measure(pools.Refresher, (server.url('/q/getdifficulty'), server.url('/api/pools/'), snapshot), options.min_time)))
+		assert pools.get_difficulty() == server.difficulty and pools.get_pool_rate(classes[0].pident_name) == 1e11
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+		(pools._difficulty, pools._pool_data) = saved
+		shutil.rmtree(directory)
+		server.shutdown()
+	return results
+
+#-------------------------------------------------------------------------------
+# CPU engine
+#-------------------------------------------------------------------------------
+
+def bench_cpu(options):
+	job = genesis_job()
+	engine = CpuEngine(0x100)
+	results = []
+	try:
+		for threads in (0x4000, 0x10000):
+			output = np.zeros(0x101, np.uint32)
+			args = kernel_args(job, uint32(job.nonce - threads / 2)) + (output,)
+			search = lambda: engine.search(None, (threads,), (64,), *args).wait()
+			search()
+			assert output[0x100] == 1 and output[0] == job.nonce
+			# the genesis hash is 0019d668 in its second word, a target just below it filters the nonce out
+			output = np.zeros(0x101, np.uint32)
+			engine.search(None, (threads,), (64,), *(args[:-2] + (uint32(0x0019d667), output))).wait()
+			assert output[0x100] == 0
+			results.append(('cpu/search/%d' % threads, measure(search, (), options.min_time)))
+	finally:
+		engine.close()
+	return results
+
+def bench_pipeline(options):
+	results = []
+	for frames in (30, 120):
+		for depth in (1, 2, 4):
+			miner = local_miner(frames, depth)
+			device = miner.devices[0]
+			job = genesis_job()
+			job.header = getwork_data(GENESIS).decode('hex')[:68]
+			job.targetQ = 1
+			miner.queue_work(job)
+			thread = Thread(target=miner.mining_thread, args=(device,))
+			thread.start()
+			# let the kernel size settle first, then average the per second launch rates
+			sleep(5)
+			rates = []
+			for i in xrange(max(int(options.min_time), 3)):
+				sleep(1)
+				rates.append(device.launch_rate)
+			launch_rate = sum(rates) / len(rates)
+			miner.should_stop = True
+			thread.join()
+			results.append(('pipeline/%d/%d' % (frames, depth), 1 / max(launch_rate, 1e-9)))
+	return results
+
+def bench_launch(options):
+	# launches per second of the smallest possible search, all arguments set per launch against only the base
+	devices = []
+	if cl:
+		devices = [device for platform in cl.get_platforms() for device in platform.get_devices()]
+	if not devices:
+		print >> sys.stderr, 'launch: needs pyopencl and an OpenCL device, skipped'
+		return []
+	miner = local_miner(30, 1, devices=devices[:1])
+	device = miner.devices[0]
+	miner.load_kernel(device)
+	queue = cl.CommandQueue(device.context)
+	output = np.zeros(miner.output_size + 1, np.uint32)
+	buffer = cl.Buffer(device.context, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR, hostbuf=output)
+	args = kernel_args(genesis_job(), 0) + (buffer,)
+	size = (device.worksize,)
+
+	def unbound():
+		for base in xrange(100):
+			device.miner.search(queue, size, size, *(args[:14] + (pack('I', base),) + args[15:]))
+		queue.finish()
+
+	kernel = cl.Kernel(device.miner, 'search')
+	kernel.set_args(*args)
+	def bound():
+		for base in xrange(100):
+			kernel.set_arg(14, pack('I', base))
+			cl.enqueue_nd_range_kernel(queue, kernel, size, size)
+		queue.finish()
+
+	return [('launch/unbound', measure(unbound, (), options.min_time) / 100),
+		('launch/bound', measure(bound, (), options.min_time) / 100)]
+
+def local_miner(frames, depth, server=None, devices=None):
+	options = local_options()
+	options.vectors = False
+	options.rate = 1
+	options.estimate = 900
+	options.frames = frames
+	options.frameSleep = 0
+	options.worksize = -1
+	options.pipeline = depth
+
+	transport = Object()
+	transport.result_queue = Queue()
+	transport.timeout = 5
+	transport.update = False
+	transport.wake = lambda: None
+	transport.prefetched = lambda: 1
+	transport.next_work = lambda: None
+
+	devices = devices or [None]
+	if server:
+		miner = BitcoinMiner(devices, options, 'benchmark', lambda miner: local_transport(server, HttpTransport, miner))
+	else:
+		miner = BitcoinMiner(devices, options, 'benchmark', lambda miner: transport)
+	miner.should_stop = False
+	return miner
+
+#-------------------------------------------------------------------------------
+# End to end
+#-------------------------------------------------------------------------------
+
+class FakeEngine(object):
+	# a device that finds the genesis nonce at the rate a device of the given speed finds shares
+	def __init__(self, output_size, hash_rate):
+		self.output_size = output_size
+		self.hash_rate = hash_rate
+		self.hashes = 0
+
+	def search(self, queue, global_size, local_size, *args):
+		self.profile = Object()
+		self.profile.queued = self.profile.start = int(time() * 1e9)
+		sleep(float(global_size[0]) / self.hash_rate)
+		self.profile.end = int(time() * 1e9)
+		self.hashes += global_size[0]
+		if self.hashes >= 2 ** 32:
+			self.hashes -= 2 ** 32
+			output = args[-1]
+			output[output[self.output_size]] = genesis_job().nonce
+			output[self.output_size] += 1
+		return self
+
+	def kernel(self):
+		return CpuKernel(self)
+
+	def wait(self):
+		pass
+
+	def close(self):
+		pass
+
+def bench_mine(options):
+	server = PoolServer().start()
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, 'w')
+	try:
+		miner = local_miner(30, 2, server)
+		miner.options.prefetch = 1
+		miner.devices[0].miner.close()
+		miner.devices[0].miner = FakeEngine(miner.output_size, 20 * 2 ** 32)
+		thread = Thread(target=miner.start)
+		thread.start()
+		sleep(1)
+		start, getworks, submits = time(), server.getworks, len(server.submits)
+		sleep(max(options.min_time, 3))
+		elapsed = time() - start
+		getworks, accepted = server.getworks - getworks, [a for t, a in server.submits[submits:]]
+		(queued, submit_time, max_submit_time) = miner.transport.submit_stats()
+		miner.stop()
+		thread.join()
+		# mining threads notice the stop within a second
+		sleep(1.1)
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+		server.shutdown()
+
+	assert all(accepted)
+	return [('mine/getwork', elapsed / max(getworks, 1)),
+		('mine/share', elapsed / max(len(accepted), 1)),
+		('mine/submit', submit_time)]
+
+#-------------------------------------------------------------------------------
+# Transport
+#-------------------------------------------------------------------------------
+
+def bench_submit(options):
+	server = PoolServer().start()
+	transport = local_transport(server)
+	thread = Thread(target=transport.loop)
+	thread.daemon = True
+	thread.start()
+	job = transport.miner.work.get(True, 10)
+
+	delays = []
+	start = time()
+	while time() - start < options.min_time or len(delays) < 3:
+		submitted = len(server.submits)
+		put_time = time()
+		transport.result_queue.put(share_result(job))
+		transport.wake()
+		while len(server.submits) == submitted:
+			sleep(0.0005)
+		assert server.submits[-1][1]
+		delays.append(server.submits[-1][0] - put_time)
+		# results are not found back to back in practice
+		sleep(0.05)
+
+	transport.stop()
+	server.shutdown()
+	return [('submit/latency', sum(delays) / len(delays))]
+
+def bench_burst(options):
+	results = []
+	for connections, batch in ((1, False), (4, False), (1, True)):
+		server = PoolServer().start()
+		server.latency = 0.02
+		transport = local_transport(server)
+		transport.config.submit_connections = connections
+		transport.batch_submit = batch
+		thread = Thread(target=transport.loop)
+		thread.daemon = True
+		thread.start()
+		job = transport.miner.work.get(True, 10)
+
+		def burst():
+			# distinct nonces the pool will reject, only the submission pipeline is measured here
+			result = share_result(job)
+			with transport.lock:
+				for nonce in xrange(1, 17):
+					transport.sent[nonce] = (False, '', '')
+					transport.send_internal(result, nonce)
+			while transport.sent:
+				sleep(0.0005)
+		results.append(('submit/burst/%s' % if_else(batch, 'batch', connections), measure(burst, (), options.min_time)))
+
+		transport.stop()
+		server.shutdown()
+	return results
+
+def bench_load(options):
+	server = PoolServer().start()
+	server.block_interval = 1
+	server.latency = 0.01
+	results = load(server, 16, max(options.min_time, 3))
+	server.shutdown()
+	return [('load/getwork', 1 / results['getworks']),
+		('load/share', results['share round trip']),
+		('load/block', results['block latency'])]
+
+def bench_stratum(options):
+	server = StratumServer().start()
+	transport = local_transport(server, StratumTransport)
+	thread = Thread(target=transport.loop)
+	thread.daemon = True
+	thread.start()
+	job = transport.miner.work.get(True, 10)
+	assert job.header == getwork_data(GENESIS).decode('hex')[:68]
+
+	results = [('stratum/job', measure(transport.decode, (transport.notify,), options.min_time))]
+	transport.stop()
+	server.shutdown()
+	return results
+
+#-------------------------------------------------------------------------------
+# Main
+#-------------------------------------------------------------------------------
+
+BENCHMARKS = [
+	('micro', bench_micro),
+	('verify', bench_verify),
+	('decode', bench_decode),
+	('roll', bench_roll),
+	('utility', bench_utility),
+	('refresh', bench_refresh),
+	('cpu', bench_cpu),
+	('pipeline', bench_pipeline),
+	('launch', bench_launch),
+	('submit', bench_submit),
+	('burst', bench_burst),
+	('load', bench_load),
+	('stratum', bench_stratum),
+	('mine', bench_mine),
+]
+
+if __name__ == '__main__':
+	parser = OptionParser(usage='usage: %prog [OPTION]... [BENCHMARK]...')
+	parser.add_option('-t', '--time', dest='min_time', default=1.0, help='minimum time per measurement in seconds, default 1', type='float')
+	parser.add_option('-o', '--output', dest='output', default='', help='also write the results as JSON to this file')
+	(options, names) = parser.parse_args()
+
+	results = []
+	for name, benchmark in BENCHMARKS:
+		if names and name not in names: continue
+		for result, seconds in benchmark(options):
+			print '%-34s %12.4f ms %12.1f /s' % (result, seconds * 1000, 1 / seconds)
+			results.append({'name': result, 'seconds': seconds, 'per_second': 1 / seconds})
+
+	if options.output:
+		with open(options.output, 'w') as f:
+			dump({'time': time(), 'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__, 'results': results}, f, indent=1)
@@ -1,5 +1,8 @@
+from collections import deque
 from datetime import datetime
-from threading import RLock
+from threading import Event, RLock, Thread
+from time import sleep, time
+import atexit
 import sys
 
 quiet = False
@@ -8,21 +11,85 @@ server = ''
 lock = RLock()
 
 TIME_FORMAT = '%d/%m/%Y %H:%M:%S'
+QUEUE_SIZE = 1024
+FLUSH_INTERVAL = 0.1
+STATUS_INTERVAL = 0.5
 
-def say(format, args=(), say_quiet=False, show_server=True):
+# callers only append records, a writer thread formats, writes and flushes them in batches
+records = deque()
+status = None
+dropped = 0
+writer = None
+
+def say(format, args=(), say_quiet=False, show_server=True, line=False):
+    global dropped
     if quiet and not say_quiet: return
-    with lock:
-        p = format % args
-        if verbose:
-            print '%s%s,' % (server if show_server else '', datetime.now().strftime(TIME_FORMAT)), p
-        else:
-            sys.stdout.write('\r%s\r%s%s' % (' '*80, server if show_server else '', p))
-        sys.stdout.flush()
+    if len(records) < QUEUE_SIZE:
+        records.append((datetime.now(), server if show_server else '', format % args, line))
+    else:
+        # a slow terminal or pipe loses messages rather than stalling the miner
+        with lock:
+            dropped += 1
+    start()
 
 def say_line(format, args=(), show_server = True):
-    if not verbose:
-        format = '%s, %s\n' % (datetime.now().strftime(TIME_FORMAT), format)
-    say(format, args, show_server=show_server)
+    say(format, args, show_server=show_server, line=True)
     
 def say_quiet(format, args=()):
-    say(format, args, True)
+    # status lines replace each other, only the latest is written and at most every STATUS_INTERVAL
+    global status
+    status = (datetime.now(), server, format % args, False)
+    start()
+
+def render(record):
+    (now, prefix, text, line) = record
+    if verbose:
+        return '%s%s, %s\n' % (prefix, now.strftime(TIME_FORMAT), text)
+    if line:
+        text = '%s, %s\n' % (now.strftime(TIME_FORMAT), text)
+    return '\r%s\r%s%s' % (' '*80, prefix, text)
+
+def start():
+    global writer
+    if writer: return
+    with lock:
+        if not writer:
+            writer = Thread(target=write_thread)
+            writer.daemon = True
+            writer.start()
+
+def write_thread():
+    global status, dropped
+    last_status = 0
+    while True:
+        sleep(FLUSH_INTERVAL)
+        batch = []
+        while records:
+            batch.append(records.popleft())
+        flushes = [record for record in batch if not isinstance(record, tuple)]
+        output = [render(record) for record in batch if isinstance(record, tuple)]
+        with lock:
+            if dropped:
+                output.append(render((datetime.now(), '', '%d log messages dropped' % dropped, True)))
+                dropped = 0
+            if status and (flushes or time() - last_status >= STATUS_INTERVAL):
+                output.append(render(status))
+                status = None
+                last_status = time()
+        if output:
+            try:
+                sys.stdout.write(''.join(output))
+                sys.stdout.flush()
+            except (IOError, ValueError):
+                pass
+        for done in flushes:
+            done.set()
+
+def flush(timeout=5):
+    # waits until everything said so far has been written
+    if not writer: return
+    done = Event()
+    records.append(done)
+    done.wait(timeout)
+
+atexit.register(flush)
@@ -64,6 +64,13 @@ __constant ulong L = 0x198c7e2a2;
 // SHA round without W calc
 #define sharound(n) { Vals[(131 - n) % 8] += t1(n); Vals[(135 - n) % 8] = t1(n) + s0(n) + ma(n); }
 
+// found nonces are appended to a dense list, output[OUTPUT_SIZE] counts them,
+// atomics on global memory are an extension before OpenCL 1.1
+#pragma OPENCL EXTENSION cl_khr_global_int32_base_atomics : enable
+#define found(nonce) { uint slot = atomic_inc(&output[OUTPUT_SIZE]); if (slot < OUTPUT_SIZE) output[slot] = nonce; }
+
+#define bswap(x) ((rotate(x, 8U) & 0x00FF00FFU) | (rotate(x, 24U) & 0xFF00FF00U))
+
 __kernel void search(	const uint state0, const uint state1, const uint state2, const uint state3,
 						const uint state4, const uint state5, const uint state6, const uint state7,
 						const uint B1, const uint C1, const uint D1,
@@ -72,6 +79,7 @@ __kernel void search(	const uint state0, const uint state1, const uint state2, c
 						const uint W2,
 						const uint W16, const uint W17,
 						const uint PreVal4, const uint T1,
+						const uint target,
 						__global uint * output)
 {
 	u W[124];
@@ -84,7 +92,7 @@ __kernel void search(	const uint state0, const uint state1, const uint state2, c
 	
 	W[2] = W2;
 #ifdef VECTORS
-        Vals[4] = (W[3] = ((base + get_global_id(0)) << 1) + (uint2)(0, 1)) + PreVal4;
+        Vals[4] = (W[3] = ((base + (uint)get_global_id(0)) << 1) + (uint2)(0, 1)) + PreVal4;
 #else
         Vals[4] = (W[3] = base + get_global_id(0)) + PreVal4;
 #endif
@@ -369,20 +377,31 @@ __kernel void search(	const uint state0, const uint state1, const uint state2, c
 	// Round 124
 	Vals[7] += Vals[3] + P4(124) + P3(124) + P2(124) + P1(124) + s1(124) + ch(124);
 	
+	// Round 125 is only needed to check the second hash word against the share target,
+	// K[60] was left out of round 124 and is added back first
 #ifdef VECTORS
-	if(Vals[7].x == -H[7])
-	{	
-		output[OUTPUT_SIZE] = output[(W[3].x >> 2) & OUTPUT_MASK] = W[3].x;
-		
-	}
-	if(Vals[7].y == -H[7])
+	if(Vals[7].x == -H[7] || Vals[7].y == -H[7])
 	{
-		output[OUTPUT_SIZE] = output[(W[3].y >> 2) & OUTPUT_MASK] =  W[3].y;
+		Vals[7] += K[60];
+		Vals[6] += Vals[2] + K[61] + H[5] + P4(125) + P3(125) + P2(125) + P1(125) + s1(125) + ch(125);
+		if(Vals[7].x == K[60] - H[7] && bswap(Vals[6].x) <= target)
+		{
+			found(W[3].x);
+		}
+		if(Vals[7].y == K[60] - H[7] && bswap(Vals[6].y) <= target)
+		{
+			found(W[3].y);
+		}
 	}
 #else
 	if(Vals[7] == -H[7])
 	{
-		output[OUTPUT_SIZE] = output[(W[3] >> 2) & OUTPUT_MASK] = W[3];
+		Vals[7] += K[60];
+		Vals[6] += Vals[2] + K[61] + H[5] + P4(125) + P3(125) + P2(125) + P1(125) + s1(125) + ch(125);
+		if(bswap(Vals[6]) <= target)
+		{
+			found(W[3]);
+		}
 	}
 #endif
 }
\ No newline at end of file
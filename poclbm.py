@@ -4,7 +4,7 @@ from BitcoinMiner import *
 from optparse import OptionGroup, OptionParser
 from time import sleep
 import HttpTransport
-import pyopencl as cl
+import StratumTransport
 import socket
 
 # Socket wrapper to enable socket.TCP_NODELAY and KEEPALIVE
@@ -29,44 +29,79 @@ group.add_option('-e', '--estimate',  dest='estimate',   default=900,         he
 group.add_option('-a', '--askrate',   dest='askrate',    default=5,           help='how many seconds between getwork requests, default 5, max 10', type='int')
 group.add_option('-t', '--tolerance', dest='tolerance',  default=2,           help='use fallback pool only after N consecutive connection errors, default 2', type='int')
 group.add_option('-b', '--failback',  dest='failback',   default=10,          help='attempt to fail back to the primary pool every N getworks, default 10', type='int')
+group.add_option('--submit-connections', dest='submit_connections', default=4, help='maximum number of concurrent share submissions per server, default 4', type='int')
+group.add_option('--batch-submit',    dest='batch_submit', action='store_true', help='submit queued shares as JSON-RPC batch requests')
+group.add_option('--prefetch',        dest='prefetch',   default=1,           help='number of decoded jobs to keep ready per pool, default 1', type='int')
+group.add_option('--prefetch-age',    dest='prefetch_age', default=60,        help='discard prefetched jobs older than N seconds, default 60', type='int')
+group.add_option('--standby',         dest='standby',    default=2,           help='keep connections and a recent job ready for the next N pools, default 2, 0 disables', type='int')
+group.add_option('--probe-interval',  dest='probe_interval', default=30,      help='seconds between health probes of the standby pools, default 30', type='int')
+group.add_option('--share-journal',   dest='share_journal', default='shares.journal', help='file shares are recorded in until the pool answered, resubmitted after a restart, default shares.journal, empty to disable')
+group.add_option('--stratum',         dest='stratum',    action='store_true', help='connect to pools with the stratum protocol and build work locally instead of using getwork')
 parser.add_option('--no-server-failbacks', dest='nsf',   action='store_true', help='disable using failback hosts provided by server')
+parser.add_option('--metrics-port',   dest='metrics_port', default=0,        help='serve metrics in JSON and Prometheus format on this port, default off', type='int')
+parser.add_option('--metrics-host',   dest='metrics_host', default='127.0.0.1', help='address the metrics endpoint listens on, default 127.0.0.1')
 parser.add_option_group(group)
 
 group = OptionGroup(parser, "Kernel Options")
 group.add_option('-p', '--platform', dest='platform',   default=-1,          help='use platform by id', type='int')
-group.add_option('-d', '--device',   dest='device',     default=-1,          help='use device by id, by default asks for device', type='int')
+group.add_option('-d', '--device',   dest='device',     default='',          help='use devices by id, comma separated, by default asks for device')
 group.add_option('-w', '--worksize', dest='worksize',   default=-1,          help='work group size, default is maximum returned by opencl', type='int')
 group.add_option('-f', '--frames',   dest='frames',     default=30,          help='will try to bring single kernel execution to 1/frames seconds, default=30, increase this for less desktop lag', type='int')
 group.add_option('-s', '--sleep',    dest='frameSleep', default=0,           help='sleep per frame in seconds, default 0', type='float')
 group.add_option('-v', '--vectors',  dest='vectors',    action='store_true', help='use vectors')
+group.add_option('--pipeline',       dest='pipeline',   default=2,           help='number of kernel launches kept in flight, default 2', type='int')
+group.add_option('--tuning-file',    dest='tuning_file', default='tuning.json', help='remember tuned settings and launch sizes per device in this file, default tuning.json, empty to disable')
+group.add_option('--autotune',       dest='autotune',   action='store_true', help='pick worksize, vectors, output size and BFI_INT per device by benchmarking them, once per device, overrides -w and -v')
+group.add_option('--kernel-cache',   dest='kernel_cache', default='kernels', help='directory compiled kernels are kept in, default kernels, empty to disable')
+group.add_option('--kernel-cache-size', dest='kernel_cache_size', default=64, help='evict the least recently used kernels beyond N megabytes, default 64', type='int')
+group.add_option('--warm-cache',     dest='warm_cache', action='store_true', help='build the kernels of all selected devices in every variant --autotune tries, then exit')
+group.add_option('-c', '--cpu',      dest='cpu',        action='store_true', help='mine on all CPU cores instead of an OpenCL device')
 parser.add_option_group(group)
 
 (options, options.servers) = parser.parse_args()
 
 
-platforms = cl.get_platforms()
-
-if options.platform >= len(platforms) or (options.platform == -1 and len(platforms) > 1):
-	print 'Wrong platform or more than one OpenCL platforms found, use --platform to select one of the following\n'
-	for i in xrange(len(platforms)):
-		print '[%d]\t%s' % (i, platforms[i].name)
+if options.cpu:
+	devices = [None]
+elif not cl:
+	print 'pyopencl is not installed, use --cpu to mine on the CPU'
 	sys.exit()
+else:
+	platforms = cl.get_platforms()
 
-if options.platform == -1:
-	options.platform = 0
+	if options.platform >= len(platforms) or (options.platform == -1 and len(platforms) > 1):
+		print 'Wrong platform or more than one OpenCL platforms found, use --platform to select one of the following\n'
+		for i in xrange(len(platforms)):
+			print '[%d]\t%s' % (i, platforms[i].name)
+		sys.exit()
 
-devices = platforms[options.platform].get_devices()
-if (options.device == -1 or options.device >= len(devices)):
-	print 'No device specified or device not found, use -d to specify one of the following\n'
-	for i in xrange(len(devices)):
-		print '[%d]\t%s' % (i, devices[i].name)
-	sys.exit()
+	if options.platform == -1:
+		options.platform = 0
+
+	devices = platforms[options.platform].get_devices()
+	try:
+		device_ids = [int(id) for id in options.device.split(',')]
+	except ValueError:
+		device_ids = []
+	# -1 asks for the list, and a device given twice would mine half of its nonce space in a second context
+	if (not device_ids or min(device_ids) < 0 or max(device_ids) >= len(devices) or len(set(device_ids)) != len(device_ids)):
+		print 'No device specified or device not found, use -d to specify one or more of the following\n'
+		for i in xrange(len(devices)):
+			print '[%d]\t%s' % (i, devices[i].name)
+		sys.exit()
+	devices = [devices[id] for id in device_ids]
+
+	if options.warm_cache:
+		BitcoinMiner(devices, options, VERSION, lambda miner: None).warm_cache()
+		sys.exit()
 
 miner = None
 try:
-	miner = BitcoinMiner(devices[options.device], options, VERSION, HttpTransport.HttpTransport)
+	transport = if_else(options.stratum, StratumTransport.StratumTransport, HttpTransport.HttpTransport)
+	miner = BitcoinMiner(devices, options, VERSION, transport)
 	miner.start()
 except KeyboardInterrupt:
+	log.flush()
 	print '\nbye'
 finally:
 	if miner: miner.stop()
@@ -1,54 +1,93 @@
+from log import say_line
+import httplib
 import json
 import math
+import os
 import re
-import scipy.integrate
+import scipy.special
+import threading
 import time
 import urllib2
 
-import httplib2
+import numpy as np
+
+DIFFICULTY_URL = 'http://blockexplorer.com/q/getdifficulty'
+POOL_DATA_URL = 'http://bitcoin.calindora.com/api/pools/'
+SNAPSHOT_FILE = 'pools.snapshot'
 
 _difficulty = (0, 0)
 _pool_data = ({}, 0)
+_refresher = None
+
+# with unchanged inputs only the clock moves progress, so a cached utility is reused for a few seconds
+UTILITY_MAX_AGE = 10
 
 #-------------------------------------------------------------------------------
 # Functions
 #-------------------------------------------------------------------------------
 
-def get_difficulty():
-	global _difficulty
-
-	if time.time() - _difficulty[1] > 3600:
-		difficulty = float(urllib2.urlopen('http://blockexplorer.com/q/getdifficulty').read())
-		_difficulty = (difficulty, time.time())
+# These only read the last known values, the refresher thread fetches them
 
+def get_difficulty():
 	return _difficulty[0]
 
 def get_pool_rate(pool):
-	global _pool_data
-
-	update_pool_data(pool)
-
-	return _pool_data[0]['rates'][pool] if pool in _pool_data[0]['rates'] else 0.0
+	return _pool_data[0].get('rates', {}).get(pool, 0.0)
 
 def get_pool_most_recent_block(pool):
-	global _pool_data
-
-	update_pool_data(pool)
-
-	return _pool_data[0]['most_recent_block'][pool] if pool in _pool_data[0]['most_recent_block'] else {}
-
-def update_pool_data(pool):
-	global _pool_data
-
-	if time.time() - _pool_data[1] > 120:
-		try:
-			h = httplib2.Http('.cache')
-			response, content = h.request('http://bitcoin.calindora.com/api/pools/')
-
-			pool_data = json.loads(content)
-			_pool_data = (pool_data, time.time())
-		except:
-			pass
+	return _pool_data[0].get('most_recent_block', {}).get(pool, {})
+
+def start_refresher(**kwargs):
+	global _refresher
+
+	if not _refresher:
+		_refresher = Refresher(**kwargs).start()
+
+	return _refresher
+
+def expected_value(progress):
+	# integral of exp(progress - x) / x from progress to 100, in closed form e^p (E1(p) - E1(100))
+	progress = np.asarray(progress, dtype=float)
+	clipped = np.minimum(progress, 700.0)
+	with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+		# e^p E1(p) overflows far beyond any real round, where it approaches its asymptotic series
+		head = np.where(progress < 700.0, np.exp(clipped) * scipy.special.exp1(clipped), (1 - 1 / progress + 2 / progress ** 2) / progress)
+		return head - np.exp(progress - 100.0) * (np.exp(100.0) * scipy.special.exp1(100.0))
+
+def update_utilities(pools):
+	# evaluates the recent blocks of all proportional pools whose inputs changed in one call
+	pools = [pool for pool in pools if isinstance(pool, ProportionalPool)]
+	if not pools: return
+	difficulty = get_difficulty()
+	now = time.time()
+	stale = []
+	for pool in pools:
+		pool.update_data()
+		blocks = tuple(sorted(get_pool_most_recent_block(pool.pident_name).items()))
+		key = (pool.rate, blocks, difficulty)
+		if pool.utility_cache and pool.utility_cache[0] == key and now - pool.utility_cache[2] < UTILITY_MAX_AGE:
+			continue
+		stale.append((pool, key))
+	if not stale: return
+	if not difficulty:
+		# nothing is known before the first fetch, the fair pools are used until then
+		for pool, key in stale:
+			pool.utility_cache = (key, 0.0, now)
+		return
+
+	index, start, probability, rate = [], [], [], []
+	for i, (pool, key) in enumerate(stale):
+		for block_time, block_probability in key[1]:
+			index.append(i)
+			start.append(float(block_time))
+			probability.append(block_probability)
+			rate.append(pool.get_rate())
+	shares = np.array(rate) * (now - np.array(start)) / 2 ** 32
+	progress = np.maximum(shares, 1.0) / difficulty
+	utilities = np.bincount(np.array(index, dtype=int), weights=np.array(probability) * expected_value(progress), minlength=len(stale))
+
+	for i, (pool, key) in enumerate(stale):
+		pool.utility_cache = (key, float(utilities[i]) * (1 - pool.fee - pool.donation), now)
 
 def get_servers(pools):
 	servers = []
@@ -80,6 +119,8 @@ def load_pool_config(filename):
 class PoolManager(object):
 	def __init__(self, config_filename='pools.conf'):
 		self.load_pools(config_filename)
+		if [pool for pool in self.pools.values() if isinstance(pool, ProportionalPool)]:
+			start_refresher()
 
 	def load_pools(self, config_filename):
 		self.pools = {}
@@ -89,8 +130,109 @@ class PoolManager(object):
 				self.pools[pool] = _pool_class_map[pool](pool_data[0], pool_data[1], pool_data[2], pool_data[3])
 
 	def get_best_pools(self):
+		update_utilities(self.pools.values())
 		return sorted(self.pools.values(), key=lambda pool: (pool.utility, pool.priority), reverse=True)
 
+#-------------------------------------------------------------------------------
+# Background Refresh
+#-------------------------------------------------------------------------------
+
+class Feed(object):
+	# one document fetched on its own schedule, retried with exponential backoff after failures
+	def __init__(self, name, url, interval, parse, timeout=10, retry=30, max_retry=1800):
+		self.name = name
+		self.url = url
+		self.interval = interval
+		self.parse = parse
+		self.timeout = timeout
+		self.retry = retry
+		self.max_retry = max_retry
+		self.failures = 0
+		self.next_fetch = 0
+
+	def fetch(self):
+		try:
+			value = self.parse(urllib2.urlopen(self.url, timeout=self.timeout).read())
+		except (IOError, httplib.HTTPException, ValueError) as e:
+			self.failures += 1
+			delay = min(self.retry * 2 ** (self.failures - 1), self.max_retry)
+			say_line('Could not fetch %s: %s, retrying in %d seconds', (self.name, e, delay), show_server=False)
+			self.next_fetch = time.time() + delay
+			return None
+
+		self.failures = 0
+		self.next_fetch = time.time() + self.interval
+		return value
+
+class Refresher(object):
+	# keeps the network difficulty and pool stats fresh, readers never wait on the network
+	def __init__(self, difficulty_url=DIFFICULTY_URL, pool_data_url=POOL_DATA_URL, snapshot=SNAPSHOT_FILE, timeout=10):
+		self.difficulty = Feed('network difficulty', difficulty_url, 3600, float, timeout)
+		self.pool_data = Feed('pool stats', pool_data_url, 120, json.loads, timeout)
+		self.snapshot = snapshot
+		self.wakeup = threading.Event()
+		self.should_stop = False
+		self.load_snapshot()
+
+	def start(self):
+		thread = threading.Thread(target=self.loop)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def stop(self):
+		self.should_stop = True
+		self.wakeup.set()
+
+	def loop(self):
+		while not self.should_stop:
+			self.wakeup.wait(self.refresh())
+			self.wakeup.clear()
+
+	def refresh(self):
+		global _difficulty, _pool_data
+
+		changed = False
+		if time.time() >= self.difficulty.next_fetch:
+			difficulty = self.difficulty.fetch()
+			if difficulty is not None:
+				_difficulty = (difficulty, time.time())
+				changed = True
+		if time.time() >= self.pool_data.next_fetch:
+			pool_data = self.pool_data.fetch()
+			if pool_data is not None:
+				_pool_data = (pool_data, time.time())
+				changed = True
+		if changed:
+			self.save_snapshot()
+
+		return max(min(self.difficulty.next_fetch, self.pool_data.next_fetch) - time.time(), 0)
+
+	def load_snapshot(self):
+		global _difficulty, _pool_data
+
+		# a fresh start hops on the last known values instead of waiting for the network
+		try:
+			with open(self.snapshot, 'r') as f:
+				snapshot = json.load(f)
+			(_difficulty, _pool_data) = (tuple(snapshot['difficulty']), tuple(snapshot['pool_data']))
+		except (IOError, ValueError, KeyError, TypeError):
+			return
+
+		self.difficulty.next_fetch = _difficulty[1] + self.difficulty.interval
+		self.pool_data.next_fetch = _pool_data[1] + self.pool_data.interval
+
+	def save_snapshot(self):
+		temp = '%s.%d.tmp' % (self.snapshot, os.getpid())
+		try:
+			with open(temp, 'w') as f:
+				json.dump({'difficulty': _difficulty, 'pool_data': _pool_data}, f)
+			if os.name == 'nt' and os.path.exists(self.snapshot):
+				os.remove(self.snapshot)
+			os.rename(temp, self.snapshot)
+		except (IOError, OSError):
+			pass
+
 #-------------------------------------------------------------------------------
 # Pool Base Class
 #-------------------------------------------------------------------------------
@@ -102,6 +244,7 @@ class Pool(object):
 		self.priority = priority
 		self.rate = 1.0
 		self.donation = donation
+		self.utility_cache = None
 
 	@property
 	def utility(self):
@@ -116,28 +259,16 @@ class Pool(object):
 class ProportionalPool(Pool):
 	@property
 	def utility(self):
-		try:
-			self.update_data()
-		except (ValueError, urllib2.HTTPError):
-			pass
-
-		blocks = get_pool_most_recent_block(self.pident_name)
-
-		utility = 0.0
+		update_utilities([self])
+		return self.utility_cache[1]
 
-		for block_time, probability in sorted(blocks.items()):
-			shares = self.get_shares(float(block_time))
-			progress = max(shares, 1.0) / get_difficulty()
-			utility += probability * scipy.integrate.quad((lambda x: (math.exp(progress - x) / x)), progress, 100.0)[0]
-
-		return utility * (1 - self.fee - self.donation)
-
-	def get_shares(self, start):
+	def get_rate(self):
 		hopper_bonus = 100.0 * 1000000000.0
 		base_rate = (math.sqrt(2) * math.sqrt(50 * (hopper_bonus ** 2) + 13 * hopper_bonus * self.rate + 50 * (self.rate ** 2)) - 10 * hopper_bonus + 10 * self.rate) / 20
-		rate = base_rate + hopper_bonus
+		return base_rate + hopper_bonus
 
-		return rate * (time.time() - start) / 2 ** 32
+	def get_shares(self, start):
+		return self.get_rate() * (time.time() - start) / 2 ** 32
 
 #-------------------------------------------------------------------------------
 # Unsupported Pools
@@ -1,3 +1,5 @@
+from collections import OrderedDict
+from threading import Lock
 from util import *
 import numpy as np
 
@@ -87,3 +89,92 @@ def hash(midstate, merkle_end, time, difficulty, nonce):
 	work[8]=0x80000000; work[15]=0x00000100
 
 	return sha256(STATE, work)
+
+def sha256_batch(state, data):
+	digest = np.empty((8, data.shape[1]), np.uint32)
+	digest[:] = state.reshape(8, -1)
+	for i in xrange(64):
+		if i > 15:
+			data[i] = R(data[i-2], data[i-7], data[i-15], data[i-16])
+		(digest[~(i-4)&7], digest[~(i-8)&7]) = sharound(digest[(~(i-1)&7)],digest[~(i-2)&7],digest[~(i-3)&7],digest[~(i-4)&7],digest[~(i-5)&7],digest[~(i-6)&7],digest[~(i-7)&7],digest[~(i-8)&7],data[i],K[i])
+	return np.add(digest, state.reshape(8, -1))
+
+def hash_batch(midstate, merkle_end, time, difficulty, nonces):
+	work = np.zeros((64, len(nonces)), np.uint32)
+	work[0]=merkle_end; work[1]=time; work[2]=difficulty; work[3]=nonces
+	work[4]=0x80000000; work[15]=0x00000280
+
+	state = sha256_batch(midstate, work)
+
+	work[:8]=state
+	work[8]=0x80000000; work[15]=0x00000100
+
+	return sha256_batch(STATE, work)
+
+#-------------------------------------------------------------------------------
+# Work precalculation with plain integers, numpy scalars are much slower
+#-------------------------------------------------------------------------------
+
+K_INT = [int(k) for k in K]
+STATE_INT = [int(s) for s in STATE]
+
+MIDSTATE_CACHE_SIZE = 64
+midstate_cache = OrderedDict()
+midstate_lock = Lock()
+
+def rotr_int(x, y):
+	return (x >> y | x << (32 - y)) & 0xFFFFFFFF
+
+def s0_int(x):
+	return rotr_int(x, 7) ^ rotr_int(x, 18) ^ (x >> 3)
+
+def s1_int(x):
+	return rotr_int(x, 17) ^ rotr_int(x, 19) ^ (x >> 10)
+
+def compress_int(state, data):
+	w = list(data)
+	for i in xrange(16, 64):
+		w.append((s1_int(w[i-2]) + w[i-7] + s0_int(w[i-15]) + w[i-16]) & 0xFFFFFFFF)
+	(a, b, c, d, e, f, g, h) = state
+	for i in xrange(64):
+		t1 = h + (rotr_int(e, 6) ^ rotr_int(e, 11) ^ rotr_int(e, 25)) + (g ^ (e & (f ^ g))) + K_INT[i] + w[i]
+		t2 = (rotr_int(a, 2) ^ rotr_int(a, 13) ^ rotr_int(a, 22)) + ((a & b) | (c & (a | b)))
+		(a, b, c, d, e, f, g, h) = ((t1 + t2) & 0xFFFFFFFF, a, b, c, (d + t1) & 0xFFFFFFFF, e, f, g)
+	return [(x + y) & 0xFFFFFFFF for x, y in zip(state, (a, b, c, d, e, f, g, h))]
+
+def midstate(data):
+	# jobs differing only in ntime, difficulty or target share the first 64 bytes
+	with midstate_lock:
+		if data in midstate_cache:
+			state = midstate_cache.pop(data)
+			midstate_cache[data] = state
+			return state
+	state = compress_int(STATE_INT, unpack('IIIIIIIIIIIIIIII', data))
+	with midstate_lock:
+		midstate_cache[data] = state
+		while len(midstate_cache) > MIDSTATE_CACHE_SIZE:
+			midstate_cache.popitem(False)
+	return state
+
+def precalculate(state, merkle_end, time, difficulty):
+	# the same state2 and f as partial followed by calculateF
+	data = (merkle_end, time, difficulty)
+	(a, b, c, d, e, f, g, h) = state
+	for i in xrange(3):
+		t1 = h + (rotr_int(e, 6) ^ rotr_int(e, 11) ^ rotr_int(e, 25)) + (g ^ (e & (f ^ g))) + K_INT[i] + data[i]
+		t2 = (rotr_int(a, 2) ^ rotr_int(a, 13) ^ rotr_int(a, 22)) + ((a & b) | (c & (a | b)))
+		(a, b, c, d, e, f, g, h) = ((t1 + t2) & 0xFFFFFFFF, a, b, c, (d + t1) & 0xFFFFFFFF, e, f, g)
+	state2 = [d, e, f, g, h, a, b, c]
+
+	w16 = (merkle_end + s0_int(time)) & 0xFFFFFFFF
+	w17 = (time + s0_int(difficulty) + 0x01100000) & 0xFFFFFFFF
+	t1 = (state[4] + (rotr_int(state2[1], 6) ^ rotr_int(state2[1], 11) ^ rotr_int(state2[1], 25)) + (state2[3] ^ (state2[1] & (state2[2] ^ state2[3]))) + 0xe9b5dba5) & 0xFFFFFFFF
+	pre = ((rotr_int(state2[5], 2) ^ rotr_int(state2[5], 13) ^ rotr_int(state2[5], 22)) + ((state2[5] & state2[6]) | (state2[7] & (state2[5] | state2[6])))) & 0xFFFFFFFF
+	return (state2, [difficulty, w16, w17, t1, pre, (w16 + s0_int(w17)) & 0xFFFFFFFF, t1, pre])
+
+def precalculate_batch(state, merkle_end, times, difficulty):
+	# precalculate works unchanged on uint32 arrays, one column per ntime value
+	n = len(times)
+	state = [np.full(n, x, np.uint32) for x in state]
+	(state2, f) = precalculate(state, np.full(n, merkle_end, np.uint32), np.asarray(times, np.uint32), np.full(n, difficulty, np.uint32))
+	return (np.array(state2), np.array(f))
@@ -0,0 +1,485 @@
+#!/usr/bin/python
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from HttpTransport import HttpTransport
+from Metrics import Metrics
+from Queue import Queue
+from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
+from StratumTransport import difficulty_target, merkle_root
+from json import dumps, loads
+from optparse import OptionParser
+from threading import Condition, Lock, Thread
+from time import sleep, time
+from util import *
+import hashlib
+import log
+import os
+import random
+import shutil
+import tempfile
+
+import pools
+
+# Genesis block header, a known-good share for every target up to difficulty 1
+GENESIS = ('01000000' + '00' * 32 +
+	'3ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a' +
+	'29ab5f49' + 'ffff001d' + '1dac2b7c').decode('hex')
+
+# Genesis coinbase transaction, the extranonces replace 8 of the zero bytes of its input
+GENESIS_COINBASE = ('01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000')
+
+DIFFICULTY_1 = 'ffffffffffffffffffffffffffffffffffffffffffffffffffffffff00000000'
+
+PADDING = '000000800000000000000000000000000000000000000000000000000000000000000000000000000000000080020000'
+
+def swap_words(data):
+	return ''.join([data[i:i+4][::-1] for i in xrange(0, len(data), 4)])
+
+def getwork_data(header):
+	return swap_words(header).encode('hex') + PADDING
+
+def header_hash(header):
+	return int(hashlib.sha256(hashlib.sha256(header).digest()).digest()[::-1].encode('hex'), 16)
+
+def target_value(target):
+	return int(target.decode('hex')[::-1].encode('hex'), 16)
+
+#-------------------------------------------------------------------------------
+# Getwork pool
+#-------------------------------------------------------------------------------
+
+class PoolHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	# the request last answered with a redirect on this connection
+	redirected = None
+
+	def do_GET(self):
+		sleep(self.server.latency)
+		if self.failed(): return
+		(request, self.redirected) = (self.redirected, None)
+		if request and (isinstance(request, list) or request.get('params')):
+			# the client followed the redirect of a submit with a GET, the shares it carried are gone
+			self.server.lost += len(request) if isinstance(request, list) else 1
+			self.reply({'result': None, 'error': {'code': -32600, 'message': 'shares lost in redirect'}, 'id': 'json'})
+			return
+		if self.path == self.server.long_poll_path:
+			self.server.wait_for_block()
+		self.reply({'result': self.server.getwork(), 'error': None, 'id': 'json'})
+
+	def do_POST(self):
+		request = loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+		sleep(self.server.latency)
+		if self.failed(): return
+		if self.server.redirect and self.path == '/':
+			self.redirected = request
+			self.send_response(307)
+			self.send_header('Location', '/redirected')
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+		if self.path == self.server.long_poll_path:
+			self.server.wait_for_block()
+		if isinstance(request, list):
+			self.reply([self.response(r) for r in request])
+		else:
+			self.reply(self.response(request))
+
+	def failed(self):
+		if random.random() >= self.server.error_rate:
+			return False
+		self.server.errors += 1
+		if random.random() < 0.5:
+			self.send_error(500)
+		self.close_connection = 1
+		return True
+
+	def response(self, request):
+		params = request.get('params', [])
+		if params: result = self.server.submit(params[0])
+		else: result = self.server.getwork()
+		return {'result': result, 'error': None, 'id': request.get('id')}
+
+	def reply(self, response):
+		body = dumps(response)
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.send_header('X-Long-Polling', self.server.long_poll_path)
+		if self.server.roll_ntime:
+			self.send_header('X-Roll-NTime', 'Y')
+		if self.server.host_list:
+			self.send_header('X-Host-List', dumps(self.server.host_list))
+		if not self.server.keep_alive:
+			self.send_header('Connection', 'close')
+			self.close_connection = 1
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+class PoolServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address=('127.0.0.1', 0), target=DIFFICULTY_1):
+		HTTPServer.__init__(self, address, PoolHandler)
+		self.target = target
+		self.latency = 0
+		self.error_rate = 0
+		self.block_interval = 0
+		self.roll_ntime = False
+		self.host_list = []
+		self.redirect = False
+		self.keep_alive = True
+		self.long_poll_path = '/LP'
+		self.header = GENESIS
+		self.block_condition = Condition()
+		self.block_time = time()
+		self.getworks = 0
+		self.errors = 0
+		self.lost = 0
+		self.submits = []
+
+	def start(self):
+		thread = Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+		thread = Thread(target=self.block_thread)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def handle_error(self, request, client_address):
+		# miners hang up on us and we hang up on them, neither is worth a traceback
+		pass
+
+	def block_thread(self):
+		while True:
+			sleep(self.block_interval or 1)
+			if self.block_interval:
+				self.new_block()
+
+	def getwork(self):
+		self.getworks += 1
+		return {'data': getwork_data(self.header), 'target': self.target}
+
+	def submit(self, data):
+		header = swap_words(data.decode('hex')[:80])
+		accepted = header[4:36] == self.header[4:36] and header_hash(header) <= target_value(self.target)
+		self.submits.append((time(), accepted))
+		return accepted
+
+	def new_block(self):
+		with self.block_condition:
+			self.header = self.header[:4] + os.urandom(32) + self.header[36:]
+			self.block_time = time()
+			self.block_condition.notify_all()
+
+	def wait_for_block(self):
+		with self.block_condition:
+			header = self.header
+			while header == self.header:
+				self.block_condition.wait()
+
+#-------------------------------------------------------------------------------
+# Stratum pool
+#-------------------------------------------------------------------------------
+
+class StratumHandler(StreamRequestHandler):
+	def setup(self):
+		StreamRequestHandler.setup(self)
+		self.write_lock = Lock()
+
+	def handle(self):
+		self.server.clients.append(self)
+		try:
+			for line in iter(self.rfile.readline, ''):
+				request = loads(line)
+				sleep(self.server.latency)
+				method, params = request['method'], request['params']
+				if method == 'mining.subscribe':
+					self.reply(request, [[['mining.notify', '1']], self.server.extranonce1, 4])
+					self.notify('mining.set_difficulty', [self.server.difficulty])
+					self.notify('mining.notify', self.server.job(True))
+				elif method == 'mining.authorize':
+					self.reply(request, True)
+				elif method == 'mining.submit':
+					self.reply(request, self.server.submit(*params[1:]))
+				else:
+					self.reply(request, None, [20, 'Unknown method', None])
+		finally:
+			self.server.clients.remove(self)
+
+	def reply(self, request, result, error=None):
+		self.write({'id': request['id'], 'result': result, 'error': error})
+
+	def notify(self, method, params):
+		self.write({'id': None, 'method': method, 'params': params})
+
+	def write(self, message):
+		with self.write_lock:
+			self.wfile.write(dumps(message) + '\n')
+			self.wfile.flush()
+
+class StratumServer(ThreadingMixIn, TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address=('127.0.0.1', 0), difficulty=1):
+		TCPServer.__init__(self, address, StratumHandler)
+		self.difficulty = difficulty
+		self.latency = 0
+		self.header = GENESIS
+		self.job_id = 0
+		self.extranonce1 = GENESIS_COINBASE[26:34]
+		self.clients = []
+		self.submits = []
+
+	def start(self):
+		thread = Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def job(self, clean):
+		header = self.header
+		return [str(self.job_id), swap_words(header[4:36]).encode('hex'), GENESIS_COINBASE[:26], GENESIS_COINBASE[42:], [],
+			header[:4][::-1].encode('hex'), header[72:76][::-1].encode('hex'), header[68:72][::-1].encode('hex'), clean]
+
+	def submit(self, job_id, extranonce2, ntime, nonce):
+		coinbase = GENESIS_COINBASE[:26] + self.extranonce1 + extranonce2 + GENESIS_COINBASE[42:]
+		header = self.header[:36] + merkle_root(coinbase.decode('hex'), []) + ntime.decode('hex')[::-1] + self.header[72:76] + nonce.decode('hex')[::-1]
+		accepted = job_id == str(self.job_id) and header_hash(header) <= target_value(difficulty_target(self.difficulty))
+		self.submits.append((time(), accepted))
+		return accepted
+
+	def new_block(self):
+		self.header = self.header[:4] + os.urandom(32) + self.header[36:]
+		self.job_id += 1
+		for client in list(self.clients):
+			client.notify('mining.notify', self.job(True))
+
+#-------------------------------------------------------------------------------
+# Pool stats
+#-------------------------------------------------------------------------------
+
+class StatsHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		sleep(self.server.latency)
+		self.server.requests += 1
+		if random.random() < self.server.error_rate:
+			self.send_error(500)
+		elif self.path == '/q/getdifficulty':
+			self.reply(repr(self.server.difficulty))
+		elif self.path == '/api/pools/':
+			self.reply(dumps(self.server.pool_data))
+		else:
+			self.send_error(404)
+
+	def reply(self, body):
+		self.send_response(200)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+class StatsServer(ThreadingMixIn, HTTPServer):
+	# stands in for the network difficulty and pool stats feeds pools.py refreshes
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address=('127.0.0.1', 0)):
+		HTTPServer.__init__(self, address, StatsHandler)
+		self.latency = 0
+		self.error_rate = 0
+		self.requests = 0
+		self.difficulty = 1500000.0
+		self.pool_data = {'rates': {}, 'most_recent_block': {}}
+
+	def start(self):
+		thread = Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def handle_error(self, request, client_address):
+		pass
+
+	def url(self, path):
+		return 'http://%s:%d%s' % (self.server_address + (path,))
+
+def register_pool(server, name='local'):
+	class LocalPool(pools.Pool):
+		pident_name = name
+		servers = ['%s:%d' % server.server_address]
+		fee = 0.0
+	LocalPool.name = name
+	pools._pool_class_map[name] = LocalPool
+	return LocalPool
+
+#-------------------------------------------------------------------------------
+# Local miners
+#-------------------------------------------------------------------------------
+
+def local_options():
+	options = Object()
+	options.askrate = 5
+	options.tolerance = 2
+	options.failback = 0
+	options.nsf = True
+	options.verbose = options.quiet = False
+	options.submit_connections = 4
+	options.batch_submit = False
+	options.prefetch = 0
+	options.prefetch_age = 60
+	options.standby = 0
+	options.probe_interval = 30
+	options.share_journal = ''
+	options.metrics_host = '127.0.0.1'
+	options.metrics_port = 0
+	options.tuning_file = ''
+	options.autotune = False
+	options.kernel_cache = ''
+	options.kernel_cache_size = 64
+	return options
+
+def local_transport(server, transport=HttpTransport, miner=None):
+	if miner:
+		return local_pool(server, transport, miner)
+	miner = Object()
+	miner.options = local_options()
+	miner.version = 'simulator'
+	miner.output_size = 0x100
+	miner.update_time = False
+	miner.metrics = Metrics()
+	miner.work = Queue()
+	miner.queue_work = miner.work.put
+	miner.set_stale = miner.stop = lambda: None
+	miner.diff1_found = lambda hash, target: None
+	miner.share_found = lambda hash, accepted, is_block: None
+	return local_pool(server, transport, miner)
+
+def local_pool(server, transport, miner):
+	register_pool(server)
+	cwd = os.getcwd()
+	directory = tempfile.mkdtemp()
+	try:
+		os.chdir(directory)
+		with open('pools.conf', 'w') as f:
+			f.write('local\tuser\tpassword\t0\n')
+		log.quiet = True
+		return transport(miner)
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(directory)
+
+class LoadTransport(HttpTransport):
+	def __init__(self, miner):
+		self.share_times = {}
+		self.round_trips = []
+		super(LoadTransport, self).__init__(miner)
+
+	def report(self, nonce, accepted, server=None):
+		if nonce in self.share_times:
+			self.round_trips.append(time() - self.share_times.pop(nonce))
+		super(LoadTransport, self).report(nonce, accepted, server)
+
+def load(server, miners=16, duration=10.0, share_interval=1.0):
+	# simulated miners, each with its own transport, asking for work and submitting shares
+	transports = []
+	block_latencies = []
+	for i in xrange(miners):
+		transport = local_transport(server, LoadTransport)
+		transport.miner.queue_work = lambda work, transport=transport: new_work(server, transport, work, block_latencies)
+		transport.last_header = None
+		transports.append(transport)
+		thread = Thread(target=transport.loop)
+		thread.daemon = True
+		thread.start()
+
+	start, getworks, errors, lost = time(), server.getworks, server.errors, server.lost
+	nonce = 0
+	while time() - start < duration:
+		sleep(share_interval / miners)
+		transport = transports[nonce % miners]
+		nonce += 1
+		with transport.lock:
+			if transport.last_header:
+				result = Object()
+				(result.header, result.time, result.difficulty, result.server) = (transport.last_header, 0, 0, transport.server)
+				transport.sent[nonce] = (False, '', '')
+				transport.share_times[nonce] = time()
+				transport.send_internal(result, nonce)
+	elapsed = time() - start
+
+	for transport in transports:
+		transport.stop()
+	# give the transport threads a moment to wind down
+	sleep(1)
+	round_trips = sum([transport.round_trips for transport in transports], [])
+	return {'getworks': (server.getworks - getworks) / elapsed,
+		'errors': server.errors - errors,
+		'lost': server.lost - lost,
+		'blocks': len(block_latencies) / max(miners, 1),
+		'block latency': sum(block_latencies) / max(len(block_latencies), 1),
+		'shares': len(round_trips) / elapsed,
+		'share round trip': sum(round_trips) / max(len(round_trips), 1)}
+
+def new_work(server, transport, work, block_latencies):
+	if not work: return
+	if transport.last_header and work.header[4:36] != transport.last_header[4:36]:
+		block_latencies.append(time() - server.block_time)
+	transport.last_header = work.header
+
+#-------------------------------------------------------------------------------
+# Main
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+	parser = OptionParser(usage='usage: %prog [OPTION]...')
+	parser.add_option('--host',     dest='host',     default='127.0.0.1', help='address to listen on, default 127.0.0.1')
+	parser.add_option('--port',     dest='port',     default=8332,        help='port to listen on, default 8332', type='int')
+	parser.add_option('--target',   dest='target',   default=DIFFICULTY_1, help='share target in getwork format, default is difficulty 1')
+	parser.add_option('--latency',  dest='latency',  default=0,           help='delay before answering each request in seconds, default 0', type='float')
+	parser.add_option('--stratum',  dest='stratum',  action='store_true', help='serve the stratum protocol instead of getwork')
+	parser.add_option('--blocks',   dest='blocks',   default=0,           help='announce a new block over long poll every N seconds, default never', type='float')
+	parser.add_option('--errors',   dest='errors',   default=0,           help='fraction of requests answered with an error or a dropped connection, default 0', type='float')
+	parser.add_option('--roll-ntime', dest='roll_ntime', action='store_true', help='allow miners to roll ntime with X-Roll-NTime')
+	parser.add_option('--host-list', dest='host_list', default='',        help='comma separated host:port failover servers announced with X-Host-List')
+	parser.add_option('--redirect', dest='redirect', action='store_true', help='answer getwork requests with a temporary redirect')
+	parser.add_option('--no-keep-alive', dest='keep_alive', action='store_false', default=True, help='close the connection after every response')
+	parser.add_option('--load',     dest='load',     default=0,           help='instead of serving, run N simulated miners against the pool and report throughput and latency', type='int')
+	parser.add_option('--duration', dest='duration', default=10,          help='load test duration in seconds, default 10', type='float')
+	(options, args) = parser.parse_args()
+
+	if options.stratum:
+		server = StratumServer((options.host, options.port))
+	else:
+		server = PoolServer((options.host, options.port), options.target)
+		server.block_interval = options.blocks
+		server.error_rate = options.errors
+		server.roll_ntime = options.roll_ntime
+		server.redirect = options.redirect
+		server.keep_alive = options.keep_alive
+		for host in filter(None, options.host_list.split(',')):
+			server.host_list.append({'host': host.rsplit(':', 1)[0], 'port': int(host.rsplit(':', 1)[1]), 'ttr': 0})
+	server.latency = options.latency
+	print 'Serving %s on %s:%d' % ((if_else(options.stratum, 'stratum', 'getwork'),) + server.server_address)
+	try:
+		if options.load and not options.stratum:
+			server.start()
+			results = load(server, options.load, options.duration)
+			print '%d miners, %d errors injected' % (options.load, results['errors'])
+			print 'getworks:         %10.1f /s' % results['getworks']
+			print 'shares:           %10.1f /s' % results['shares']
+			print 'shares lost:      %10d' % results['lost']
+			print 'share round trip: %10.1f ms' % (results['share round trip'] * 1000)
+			print 'block latency:    %10.1f ms over %d blocks' % (results['block latency'] * 1000, results['blocks'])
+			server.shutdown()
+		else:
+			server.serve_forever()
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,28 @@
+from json import dump, load
+from threading import Lock
+import os
+
+# tuned settings and launch rates, remembered per device between runs
+
+lock = Lock()
+
+def load_tuning(path):
+	try:
+		with open(path, 'r') as f:
+			return load(f)
+	except (IOError, ValueError):
+		return {}
+
+def save_tuning(path, section, key, value):
+	with lock:
+		tuning = load_tuning(path)
+		tuning.setdefault(section, {})[key] = value
+		temp = '%s.%d.tmp' % (path, os.getpid())
+		try:
+			with open(temp, 'w') as f:
+				dump(tuning, f, indent=1, sort_keys=True)
+			if os.name == 'nt' and os.path.exists(path):
+				os.remove(path)
+			os.rename(temp, path)
+		except (IOError, OSError):
+			pass
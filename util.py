@@ -1,4 +1,5 @@
 from struct import pack, unpack, error
+import numpy as np
 
 class Object(object):
     pass
@@ -18,6 +19,15 @@ def belowOrEquals(hash, target):
             return False
     return True
 
+def belowOrEqualsBatch(hashes, target):
+    result = np.ones(hashes.shape[1], bool)
+    decided = np.zeros(hashes.shape[1], bool)
+    for i in range(len(hashes) - 1, -1, -1):
+        reversed = bytereverse(hashes[i])
+        result &= decided | (reversed <= target[i])
+        decided |= reversed != target[i]
+    return result
+
 def if_else(condition, trueVal, falseVal):
     if condition:
         return trueVal